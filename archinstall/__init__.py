@@ -4,6 +4,7 @@ import urllib.parse
 import urllib.request
 from argparse import ArgumentParser
 
+from .lib.accounting import *
 from .lib.disk import *
 from .lib.exceptions import *
 from .lib.general import *
@@ -28,6 +29,8 @@ from .lib.packages.packages import (
 	installed_package,
 	validate_package_list,
 )
+from .lib.probe_cache import *
+from .lib.replay import *
 from .lib.profiles import *
 from .lib.services import *
 from .lib.storage import *
@@ -0,0 +1,132 @@
+import json
+import logging
+import os
+import threading
+from dataclasses import dataclass, asdict
+from typing import Any, Callable, Dict, List, Optional
+
+from .output import log, BufferedLogFile
+
+
+@dataclass
+class CommandRecord:
+	"""
+	Resource usage of a single command executed through :ref:`SysCommandWorker`.
+	CPU times are in seconds and ``max_rss`` is in KiB, as reported by ``wait4()``.
+	"""
+	cmd: List[str]
+	started: float
+	ended: float
+	exit_code: Optional[int]
+	output_bytes: int
+	user_time: float = 0.0
+	system_time: float = 0.0
+	max_rss: int = 0
+
+	@property
+	def wall_time(self) -> float:
+		return self.ended - self.started
+
+	@property
+	def name(self) -> str:
+		return os.path.basename(self.cmd[0]) if self.cmd else ''
+
+	def json(self) -> Dict[str, Any]:
+		return {**asdict(self), 'wall_time': self.wall_time}
+
+
+class CommandStatistics:
+	"""
+	An in-memory sink that aggregates :ref:`CommandRecord`'s per binary,
+	and can produce a report of the most expensive ones.
+	"""
+	def __init__(self) -> None:
+		self.records :List[CommandRecord] = []
+		self._lock = threading.Lock()
+
+	def __call__(self, record :CommandRecord) -> None:
+		with self._lock:
+			self.records.append(record)
+
+	def clear(self) -> None:
+		with self._lock:
+			self.records = []
+
+	def summary(self) -> Dict[str, Dict[str, Any]]:
+		result :Dict[str, Dict[str, Any]] = {}
+
+		with self._lock:
+			records = list(self.records)
+
+		for record in records:
+			entry = result.setdefault(record.name, {'calls': 0, 'wall_time': 0.0, 'cpu_time': 0.0, 'max_rss': 0, 'output_bytes': 0, 'failures': 0})
+			entry['calls'] += 1
+			entry['wall_time'] += record.wall_time
+			entry['cpu_time'] += record.user_time + record.system_time
+			entry['max_rss'] = max(entry['max_rss'], record.max_rss)
+			entry['output_bytes'] += record.output_bytes
+			if record.exit_code != 0:
+				entry['failures'] += 1
+
+		return result
+
+	def report(self, top :int = 10, sort_by :str = 'wall_time') -> str:
+		"""
+		Returns a human readable report of the ``top`` commands,
+		sorted by ``wall_time`` or ``calls`` for instance.
+		"""
+		summary = self.summary()
+		lines = []
+
+		for name, entry in sorted(summary.items(), key=lambda item: item[1][sort_by], reverse=True)[:top]:
+			lines.append(
+				f"{name} called {entry['calls']} times, {entry['wall_time']:.1f} s total "
+				f"({entry['cpu_time']:.1f} s CPU, max RSS {entry['max_rss']} KiB, {entry['output_bytes']} bytes of output, {entry['failures']} failed)"
+			)
+
+		return '\n'.join(lines)
+
+
+class JsonLinesSink:
+	"""
+	A sink that appends each :ref:`CommandRecord` as one JSON object per line to ``path``.
+	The file is kept open and buffered like the command history (see :ref:`BufferedLogFile`),
+	use :py:meth:`flush` to have everything written so far show up in it.
+	"""
+	def __init__(self, path :str) -> None:
+		self.path = path
+		# An absolute path isn't put under storage['LOG_PATH'] by BufferedLogFile
+		self._file = BufferedLogFile(os.path.abspath(path))
+
+	def __call__(self, record :CommandRecord) -> None:
+		self._file.write(json.dumps(record.json()) + '\n')
+
+	def flush(self) -> None:
+		self._file.flush()
+
+	def close(self) -> None:
+		self._file.close()
+
+
+# The in-memory aggregator is always active, further sinks (including plain callbacks) can be added.
+command_statistics = CommandStatistics()
+_sinks :List[Callable[[CommandRecord], Any]] = [command_statistics]
+
+
+def add_command_sink(sink :Callable[[CommandRecord], Any]) -> None:
+	if sink not in _sinks:
+		_sinks.append(sink)
+
+
+def remove_command_sink(sink :Callable[[CommandRecord], Any]) -> None:
+	if sink in _sinks:
+		_sinks.remove(sink)
+
+
+def record_command(record :CommandRecord) -> None:
+	for sink in list(_sinks):
+		try:
+			sink(record)
+		except Exception as error:
+			# Accounting should never be the reason a command fails
+			log(f"Command accounting sink {sink} failed: {error}", level=logging.DEBUG)
@@ -1,7 +1,10 @@
 from .btrfs import *
 from .helpers import *
+from .inventory import *
+from .monitor import *
+from .mounttable import *
 from .blockdevice import BlockDevice
-from .filesystem import Filesystem, MBR, GPT
+from .filesystem import Filesystem, MBR, GPT, load_layouts
 from .partition import *
 from .user_guides import *
 from .validators import *
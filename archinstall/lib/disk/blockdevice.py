@@ -1,8 +1,7 @@
 from __future__ import annotations
 import os
-import json
 import logging
-import time
+import threading
 from typing import Optional, Dict, Any, Iterator, Tuple, List, TYPE_CHECKING
 # https://stackoverflow.com/a/39757388/929999
 if TYPE_CHECKING:
@@ -10,8 +9,38 @@ if TYPE_CHECKING:
 	
 from ..exceptions import DiskError, SysCallError
 from ..output import log
-from ..general import SysCommand
+from ..general import SysCommand, SysCommandWorker
 from ..storage import storage
+from ..probe_cache import probe_cache
+from .inventory import device_inventory
+from .monitor import wait_for_devices, device_deadline
+from .partition_table import PartitionTable
+
+# How many times partition tables were re-read, per device and what asked for it
+_rescans :Dict[Tuple[str, str], int] = {}
+_rescans_lock = threading.Lock()
+
+def record_rescan(device :str, requested_by :str) -> None:
+	"""
+	Keeps track of a partition table rescan (partprobe) of ``device``, and who asked for it.
+	"""
+	with _rescans_lock:
+		_rescans[(device, requested_by)] = _rescans.get((device, requested_by), 0) + 1
+
+	log(f"Rescanning the partition table of {device}, requested by {requested_by}", level=logging.DEBUG)
+
+def rescan_statistics() -> Dict[str, int]:
+	"""
+	Returns how many partition table rescans each caller requested, most frequent first.
+	"""
+	requesters :Dict[str, int] = {}
+	with _rescans_lock:
+		rescans = list(_rescans.items())
+
+	for (device, requested_by), count in rescans:
+		requesters[requested_by] = requesters.get(requested_by, 0) + count
+
+	return dict(sorted(requesters.items(), key=lambda item: item[1], reverse=True))
 
 class BlockDevice:
 	def __init__(self, path :str, info :Optional[Dict[str, Any]] = None):
@@ -25,6 +54,8 @@ class BlockDevice:
 		self.info = info
 		self.keep_partitions = True
 		self.part_cache = {}
+		self._partition_table :Optional[PartitionTable] = None
+		self._partition_table_generation :Optional[Tuple[Any, ...]] = None
 
 		# TODO: Currently disk encryption is a BIT misleading.
 		#       It's actually partition-encryption, but for future-proofing this
@@ -65,11 +96,39 @@ class BlockDevice:
 		}
 
 	@property
-	def partition_type(self) -> str:
-		output = json.loads(SysCommand(f"lsblk --json -o+PTTYPE {self.path}").decode('UTF-8'))
+	def inventory_info(self) -> Dict[str, Any]:
+		"""
+		Returns what the shared :ref:`DeviceInventory` snapshot knows about this device (``lsblk -O`` columns).
+		"""
+		if (info := device_inventory().get(self.path)) is None:
+			raise DiskError(f'Could not find {self.path} in the block device inventory')
 
-		for device in output['blockdevices']:
-			return device['pttype']
+		return info
+
+	@property
+	def partition_table(self) -> PartitionTable:
+		"""
+		The parsed partition table of the disk. It's read once and kept until something
+		changes the partitioning of the disk, see :py:meth:`invalidate_partition_table`.
+		"""
+		generation = probe_cache.device_generation(self.path)
+
+		if self._partition_table is None or generation is None or generation != self._partition_table_generation:
+			self._partition_table = PartitionTable.read(self.path)
+			self._partition_table_generation = generation
+
+		return self._partition_table
+
+	def invalidate_partition_table(self) -> None:
+		"""
+		Forces the partition table to be read again on next use. Any mutating command executed through
+		:ref:`SysCommand` on this disk does this implicitly, this is for changes made any other way.
+		"""
+		self._partition_table = None
+
+	@property
+	def partition_type(self) -> str:
+		return self.inventory_info['pttype']
 
 	@property
 	def device_or_backfile(self) -> str:
@@ -121,24 +180,17 @@ class BlockDevice:
 	def partitions(self) -> Dict[str, Partition]:
 		from .filesystem import Partition
 
-		self.partprobe()
-		result = SysCommand(['/usr/bin/lsblk', '-J', self.path])
+		inventory = device_inventory()
 
-		if b'not a block device' in result:
+		if (info := inventory.get(self.path)) is None:
 			raise DiskError(f'Can not read partitions off something that isn\'t a block device: {self.path}')
 
-		if not result[:1] == b'{':
-			raise DiskError('Error getting JSON output from:', f'/usr/bin/lsblk -J {self.path}')
-
-		r = json.loads(result.decode('UTF-8'))
-		if len(r['blockdevices']) and 'children' in r['blockdevices'][0]:
-			root_path = f"/dev/{r['blockdevices'][0]['name']}"
-			for part in r['blockdevices'][0]['children']:
-				part_id = part['name'][len(os.path.basename(self.path)):]
-				if part_id not in self.part_cache:
-					# TODO: Force over-write even if in cache?
-					if part_id not in self.part_cache or self.part_cache[part_id].size != part['size']:
-						self.part_cache[part_id] = Partition(root_path + part_id, self, part_id=part_id)
+		root_path = f"/dev/{info['name']}"
+		for part in inventory.children(self.path):
+			part_id = part['name'][len(os.path.basename(self.path)):]
+			if part_id not in self.part_cache:
+				# TODO: Force over-write even if in cache?
+				self.part_cache[part_id] = Partition(root_path + part_id, self, part_id=part_id)
 
 		return {k: self.part_cache[k] for k in sorted(self.part_cache)}
 
@@ -162,30 +214,21 @@ class BlockDevice:
 		This is more reliable than relying on /dev/disk/by-partuuid as
 		it doesn't seam to be able to detect md raid partitions.
 		"""
-		return SysCommand(f'blkid -s PTUUID -o value {self.path}').decode('UTF-8')
+		return SysCommand(f'blkid -s PTUUID -o value {self.path}', mode='pipe').decode('UTF-8')
 
 	@property
 	def size(self) -> float:
 		from .helpers import convert_size_to_gb
 
-		output = json.loads(SysCommand(f"lsblk --json -b -o+SIZE {self.path}").decode('UTF-8'))
-
-		for device in output['blockdevices']:
-			return convert_size_to_gb(device['size'])
+		return convert_size_to_gb(self.inventory_info['size'])
 
 	@property
 	def bus_type(self) -> str:
-		output = json.loads(SysCommand(f"lsblk --json -o+ROTA,TRAN {self.path}").decode('UTF-8'))
-
-		for device in output['blockdevices']:
-			return device['tran']
+		return self.inventory_info['tran']
 
 	@property
 	def spinning(self) -> bool:
-		output = json.loads(SysCommand(f"lsblk --json -o+ROTA,TRAN {self.path}").decode('UTF-8'))
-
-		for device in output['blockdevices']:
-			return device['rota'] is True
+		return self.inventory_info['rota'] is True
 
 	@property
 	def free_space(self) -> Tuple[str, str, str]:
@@ -194,8 +237,8 @@ class BlockDevice:
 		# so the free will ignore the ESP partition and just give the "free" space.
 		# Doesn't harm us, but worth noting in case something weird happens.
 		try:
-			for line in SysCommand(f"parted -s --machine {self.path} print free"):
-				if 'free' in (free_space := line.decode('UTF-8')):
+			for free_space in SysCommandWorker(f"parted -s --machine {self.path} print free").stream():
+				if 'free' in free_space:
 					_, start, end, size, *_ = free_space.strip('\r\n;').split(':')
 					yield (start, end, size)
 		except SysCallError as error:
@@ -229,9 +272,22 @@ class BlockDevice:
 			end = f"{self.size}GB"
 		return end
 
-	def partprobe(self) -> bool:
+	def partprobe(self, requested_by :str = 'BlockDevice.partprobe()') -> bool:
+		record_rescan(self.path, requested_by)
 		return SysCommand(['partprobe', self.path]).exit_code == 0
 
+	def refresh(self, requested_by :str = 'BlockDevice.refresh()') -> bool:
+		"""
+		Makes the kernel re-read the partition table of the disk, and forgets what we read of it.
+		None of the properties do this on their own, so this has to be called after changing
+		the disk any other way than through :ref:`Filesystem`.
+
+		:param requested_by: What needed the rescan, for :py:func:`rescan_statistics`.
+		"""
+		result = self.partprobe(requested_by)
+		self.invalidate_partition_table()
+		return result
+
 	def has_partitions(self) -> int:
 		return len(self.partitions)
 
@@ -245,17 +301,22 @@ class BlockDevice:
 		self.part_cache = {}
 
 	def get_partition(self, uuid :str) -> Partition:
-		count = 0
-		while count < 5:
-			for partition_uuid, partition in self.partitions.items():
-				if partition.uuid.lower() == uuid.lower():
-					return partition
-			else:
-				log(f"uuid {uuid} not found. Waiting for {count +1} time",level=logging.DEBUG)
-				time.sleep(float(storage['arguments'].get('disk-sleep', 0.2)))
-				count += 1
+		def find_partition() -> Optional[Partition]:
+			for partition in self.partitions.values():
+				try:
+					if partition.uuid.lower() == uuid.lower():
+						return partition
+				except DiskError:
+					# Not visible yet, the kernel or udev is still catching up
+					pass
+
+			log(f"uuid {uuid} not found, waiting for device events", level=logging.DEBUG)
+
+		# The same time the five retries of disk-sleep used to take, except that it ends as soon as the partition shows up
+		if (partition := wait_for_devices(find_partition, device_deadline(5 * float(storage['arguments'].get('disk-sleep', 0.2))))):
+			return partition
 		else:
-			log(f"Could not find {uuid} in disk after 5 retries",level=logging.INFO)
+			log(f"Could not find {uuid} in disk in time",level=logging.INFO)
 			print(f"Cache: {self.part_cache}")
 			print(f"Partitions: {self.partitions.items()}")
 			print(f"UUID: {[uuid]}")
@@ -1,12 +1,8 @@
 import pathlib
-import logging
-import json
 from dataclasses import dataclass
 from typing import Optional
-from ..exceptions import SysCallError
-from ..general import SysCommand
-from ..output import log
 from .mapperdev import MapperDev
+from .mounttable import mount_table
 
 @dataclass
 class DMCryptDev:
@@ -31,17 +27,7 @@ class DMCryptDev:
 
 	@property
 	def mountpoint(self) -> Optional[str]:
-		try:
-			data = json.loads(SysCommand(f"findmnt --json -R {self.dev_path}").decode())
-			for filesystem in data['filesystems']:
-				return filesystem.get('target')
-
-		except SysCallError as error:
-			# Not mounted anywhere most likely
-			log(f"Could not locate mount information for {self.dev_path}: {error}", level=logging.WARNING, fg="yellow")
-			pass
-
-		return None
+		return mount_table().mountpoint(self.dev_path)
 
 	@property
 	def filesystem(self) -> Optional[str]:
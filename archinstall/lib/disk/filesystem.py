@@ -1,17 +1,21 @@
 from __future__ import annotations
 import time
 import logging
-import json
 import pathlib
-from typing import Optional, Dict, Any, TYPE_CHECKING
+import functools
+from typing import Optional, Dict, Any, List, Set, TYPE_CHECKING
 # https://stackoverflow.com/a/39757388/929999
 if TYPE_CHECKING:
 	from .blockdevice import BlockDevice
 	_: Any
 
+from .blockdevice import record_rescan
+from .helpers import partuuid_to_partition_number, run_per_device
+from .layout import compile_layout
+from .monitor import device_deadline, settle_devices, wait_for_devices
 from .partition import Partition
 from .validators import valid_fs_type
-from ..exceptions import DiskError
+from ..exceptions import DiskError, SysCallError
 from ..general import SysCommand
 from ..output import log
 from ..storage import storage
@@ -47,29 +51,19 @@ class Filesystem:
 		return True
 
 	def partuuid_to_index(self, uuid :str) -> Optional[int]:
-		for i in range(storage['DISK_RETRY_ATTEMPTS']):
-			self.partprobe()
-			time.sleep(5)
-
-			# We'll use unreliable lbslk to grab children under the /dev/<device>
-			output = json.loads(SysCommand(f"lsblk --json {self.blockdevice.device}").decode('UTF-8'))
-
-			for device in output['blockdevices']:
-				for index, partition in enumerate(device['children']):
-					# But we'll use blkid to reliably grab the PARTUUID for that child device (partition)
-					partition_uuid = SysCommand(f"blkid -s PARTUUID -o value /dev/{partition.get('name')}").decode().strip()
-					if partition_uuid.lower() == uuid.lower():
-						return index
-
-			time.sleep(storage['DISK_TIMEOUTS'])
+		# The partition has usually been around for a while, in which case this doesn't wait at all
+		if (partition_number := wait_for_devices(lambda: partuuid_to_partition_number(self.blockdevice.device, uuid), device_deadline())):
+			# parted counts from 1, but the callers add that themselves
+			return partition_number - 1
 
 		raise DiskError(f"Failed to convert PARTUUID {uuid} to a partition index number on blockdevice {self.blockdevice.device}")
 
 	def load_layout(self, layout :Dict[str, Any]) -> None:
-		from ..luks import luks2
+		# All new partitions are created at once if possible, otherwise they're added one by one below
+		created = self.create_partitions(layout)
 
-		# If the layout tells us to wipe the drive, we do so
-		if layout.get('wipe', False):
+		# If the layout tells us to wipe the drive, we do so (unless the partitions were created on a new label already)
+		if created is None and layout.get('wipe', False):
 			if self.mode == GPT:
 				if not self.parted_mklabel(self.blockdevice.device, "gpt"):
 					raise KeyError(f"Could not create a GPT label on {self}")
@@ -80,10 +74,13 @@ class Filesystem:
 			self.blockdevice.flush_cache()
 
 		prev_partition = None
+		encryption = {}
 		# We then iterate the partitions in order
 		for partition in layout.get('partitions', []):
+			if created and id(partition) in created:
+				partition['device_instance'] = created[id(partition)]
 			# We don't want to re-add an existing partition (those containing a UUID already)
-			if partition.get('wipe', False) and not partition.get('PARTUUID', None):
+			elif partition.get('wipe', False) and not partition.get('PARTUUID', None):
 				print(_("Adding partition...."))
 				start = partition.get('start') or (
 					prev_partition and f'{prev_partition["device_instance"].end_sectors}s' or DEFAULT_PARTITION_START)
@@ -125,43 +122,135 @@ class Filesystem:
 					else:
 						loopdev = f"{storage.get('ENC_IDENTIFIER', 'ai')}{pathlib.Path(partition['device_instance'].path).name}"
 
-					partition['device_instance'].encrypt(password=partition['!password'])
-					# Immediately unlock the encrypted device to format the inner volume
-					with luks2(partition['device_instance'], loopdev, partition['!password'], auto_unmount=True) as unlocked_device:
-						if not partition.get('wipe'):
-							if storage['arguments'] == 'silent':
-								raise ValueError(f"Missing fs-type to format on newly created encrypted partition {partition['device_instance']}")
-							else:
-								if not partition.get('filesystem'):
-									partition['filesystem'] = {}
-
-								if not partition['filesystem'].get('format', False):
-									while True:
-										partition['filesystem']['format'] = input(f"Enter a valid fs-type for newly encrypted partition {partition['filesystem']['format']}: ").strip()
-										if not partition['filesystem']['format'] or valid_fs_type(partition['filesystem']['format']) is False:
-											print(_("You need to enter a valid fs-type in order to continue. See `man parted` for valid fs-type's."))
-											continue
-										break
-
-						unlocked_device.format(partition['filesystem']['format'], options=format_options)
+					if not partition.get('wipe'):
+						if storage['arguments'] == 'silent':
+							raise ValueError(f"Missing fs-type to format on newly created encrypted partition {partition['device_instance']}")
+						else:
+							if not partition.get('filesystem'):
+								partition['filesystem'] = {}
+
+							if not partition['filesystem'].get('format', False):
+								while True:
+									partition['filesystem']['format'] = input(f"Enter a valid fs-type for newly encrypted partition {partition['filesystem']['format']}: ").strip()
+									if not partition['filesystem']['format'] or valid_fs_type(partition['filesystem']['format']) is False:
+										print(_("You need to enter a valid fs-type in order to continue. See `man parted` for valid fs-type's."))
+										continue
+									break
+
+					# Encrypting takes a deliberately slow key derivation, which the partitions can do side by side once they all exist
+					encryption[partition['device_instance'].path] = functools.partial(self.encrypt_partition, partition, loopdev, format_options)
 				elif partition.get('wipe', False):
 					if not partition['device_instance']:
 						raise DiskError(f"Internal error caused us to loose the partition. Please report this issue upstream!")
 
 					partition['device_instance'].format(partition['filesystem']['format'], options=format_options)
 
-			if partition.get('boot', False):
+			if partition.get('boot', False) and not (created and id(partition) in created):
 				log(f"Marking partition {partition['device_instance']} as bootable.")
 				self.set(self.partuuid_to_index(partition['device_instance'].uuid), 'boot on')
 
 			prev_partition = partition
 
+		if encryption:
+			run_per_device(encryption, 'encrypt')
+
+	def encrypt_partition(self, partition :Dict[str, Any], loopdev :str, format_options :List[str]) -> None:
+		"""
+		Encrypts a partition of a ``disk_layouts`` entry, unlocks it as ``loopdev`` and formats the inner volume.
+		"""
+		from ..luks import luks2
+
+		partition['device_instance'].encrypt(password=partition['!password'])
+		# Immediately unlock the encrypted device to format the inner volume
+		with luks2(partition['device_instance'], loopdev, partition['!password'], auto_unmount=True) as unlocked_device:
+			unlocked_device.format(partition['filesystem']['format'], options=format_options)
+
+	def create_partitions(self, layout :Dict[str, Any]) -> Optional[Dict[int, Partition]]:
+		"""
+		Creates every new partition of a ``disk_layouts`` entry (including the partition table if it's to be wiped)
+		with a single ``sfdisk`` run, see :py:func:`compile_layout`. Boot partitions get their type or flag right away.
+
+		Returns the created :ref:`Partition` instances by the ``id()`` of their layout entry,
+		or None if the layout can't be created that way.
+		"""
+		label = 'gpt' if self.mode == GPT else 'dos'
+		info = self.blockdevice.inventory_info
+
+		# New partitions without a start go right after the existing partition in front of them
+		existing_ends = {}
+		if not layout.get('wipe', False):
+			for partition in layout.get('partitions', []):
+				if partition_uuid := partition.get('PARTUUID', None):
+					try:
+						existing_ends[partition_uuid] = self.blockdevice.get_partition(uuid=partition_uuid).end_sectors
+					except DiskError:
+						pass
+
+		try:
+			script, entries = compile_layout(layout, label, info['log-sec'], info['size'], DEFAULT_PARTITION_START, existing_ends)
+		except ValueError as error:
+			log(f"Creating the partitions on {self.blockdevice.device} one by one: {error}", level=logging.DEBUG)
+			return None
+
+		if layout.get('wipe', False):
+			existing = set()
+			# Like parted mklabel, clear the signatures of whatever was on the disk before
+			cmd = ['sfdisk', '--wipe', 'always', self.blockdevice.device]
+
+			# Try to unmount devices before replacing the partition table
+			try:
+				SysCommand(f'bash -c "umount {self.blockdevice.device}?"')
+			except:
+				pass
+		elif not entries:
+			return {}
+		else:
+			try:
+				existing = set(self.blockdevice.partition_table.partitions)
+			except SysCallError as error:
+				log(f"Creating the partitions on {self.blockdevice.device} one by one, its partition table can't be read: {error}", level=logging.DEBUG)
+				return None
+
+			cmd = ['sfdisk', '--append', self.blockdevice.device]
+
+		log(f"Partitioning {self.blockdevice.device} using the following sfdisk script:\n{script}", level=logging.DEBUG)
+
+		try:
+			SysCommand(cmd, mode='pipe', stdin=script.encode('UTF-8'))
+		except SysCallError as error:
+			# sfdisk refuses to touch a disk that's in use for instance, which parted might still get away with
+			log(f"Creating the partitions on {self.blockdevice.device} one by one, sfdisk failed: {error}", level=logging.DEBUG)
+			return None
+		finally:
+			self.blockdevice.invalidate_partition_table()
+			self.blockdevice.flush_cache()
+
+		# sfdisk has told the kernel about the new partitions, mapping them back to the layout is all that's left
+		nodes = [node for node in self.blockdevice.partition_table.partitions if node not in existing]
+		if len(nodes) != len(entries):
+			raise DiskError(f"Expected {len(entries)} new partitions on {self.blockdevice.device}, but found {nodes}")
+
+		def created_partitions() -> Optional[List[Partition]]:
+			partitions = {partition.path: partition for partition in self.blockdevice.partitions.values()}
+			# Partition.size doesn't wait for the kernel/udev to publish a partition, so it's done here
+			if all(node in partitions and partitions[node].inventory_info.get('size') is not None for node in nodes):
+				return [partitions[node] for node in nodes]
+
+		deadline = device_deadline()
+		settle_devices(deadline)
+
+		if not (partitions := wait_for_devices(created_partitions, deadline)):
+			raise DiskError(f"New partitions {nodes} never showed up after partitioning {self.blockdevice.device}")
+
+		return {id(entry): partition for entry, partition in zip(entries, partitions)}
+
 	def find_partition(self, mountpoint :str) -> Partition:
 		for partition in self.blockdevice:
 			if partition.target_mountpoint == mountpoint or partition.mountpoint == mountpoint:
 				return partition
 
-	def partprobe(self) -> bool:
+	def partprobe(self, requested_by :str = 'Filesystem.partprobe()') -> bool:
+		record_rescan(self.blockdevice.device, requested_by)
 		result = SysCommand(f'partprobe {self.blockdevice.device}')
 
 		if result.exit_code != 0:
@@ -171,8 +260,13 @@ class Filesystem:
 		return True
 
 	def raw_parted(self, string: str) -> SysCommand:
-		if (cmd_handle := SysCommand(f'/usr/bin/parted -s {string}')).exit_code != 0:
-			log(f"Parted ended with a bad exit code: {cmd_handle}", level=logging.ERROR, fg="red")
+		try:
+			if (cmd_handle := SysCommand(f'/usr/bin/parted -s {string}')).exit_code != 0:
+				log(f"Parted ended with a bad exit code: {cmd_handle}", level=logging.ERROR, fg="red")
+		finally:
+			# Even a failed parted run might have changed the partition table
+			self.blockdevice.invalidate_partition_table()
+
 		time.sleep(0.5)
 		return cmd_handle
 
@@ -184,7 +278,7 @@ class Filesystem:
 		:type string: str
 		"""
 		if (parted_handle := self.raw_parted(string)).exit_code == 0:
-			return self.partprobe()
+			return self.partprobe('Filesystem.parted()')
 		else:
 			raise DiskError(f"Parted failed to add a partition: {parted_handle}")
 
@@ -195,7 +289,7 @@ class Filesystem:
 	def add_partition(self, partition_type :str, start :str, end :str, partition_format :Optional[str] = None) -> Partition:
 		log(f'Adding partition to {self.blockdevice}, {start}->{end}', level=logging.INFO)
 
-		previous_partition_uuids = {partition.uuid for partition in self.blockdevice.partitions.values()}
+		previous_partition_uuids = self._partition_uuids()
 
 		if self.mode == MBR:
 			if len(self.blockdevice.partitions) > 3:
@@ -209,28 +303,30 @@ class Filesystem:
 		log(f"Adding partition using the following parted command: {parted_string}", level=logging.DEBUG)
 
 		if self.parted(parted_string):
-			count = 0
-			while count < 10:
-				new_uuid = None
-				new_uuid_set = (previous_partition_uuids ^ {partition.uuid for partition in self.blockdevice.partitions.values()})
+			def new_partition_uuids() -> Set[str]:
+				if not (new_uuid_set := previous_partition_uuids ^ self._partition_uuids()):
+					log(f"Could not get UUID for partition. Waiting for device events ...", level=logging.DEBUG)
 
-				if len(new_uuid_set) > 0:
-					new_uuid = new_uuid_set.pop()
+				return new_uuid_set
 
-				if new_uuid:
-					try:
-						return self.blockdevice.get_partition(new_uuid)
-					except Exception as err:
-						log(f'Blockdevice: {self.blockdevice}', level=logging.ERROR, fg="red")
-						log(f'Partitions: {self.blockdevice.partitions}', level=logging.ERROR, fg="red")
-						log(f'Partition set: {new_uuid_set}', level=logging.ERROR, fg="red")
-						log(f'New UUID: {[new_uuid]}', level=logging.ERROR, fg="red")
-						log(f'get_partition(): {self.blockdevice.get_partition}', level=logging.ERROR, fg="red")
-						raise err
-				else:
-					count += 1
-					log(f"Could not get UUID for partition. Waiting before retry attempt {count} of 10 ...",level=logging.DEBUG)
-					time.sleep(float(storage['arguments'].get('disk-sleep', 0.2)))
+			if new_uuid_set := wait_for_devices(new_partition_uuids, device_deadline()):
+				new_uuid = new_uuid_set.pop()
+
+				try:
+					partition = self.blockdevice.get_partition(new_uuid)
+				except Exception as err:
+					log(f'Blockdevice: {self.blockdevice}', level=logging.ERROR, fg="red")
+					log(f'Partitions: {self.blockdevice.partitions}', level=logging.ERROR, fg="red")
+					log(f'Partition set: {new_uuid_set}', level=logging.ERROR, fg="red")
+					log(f'New UUID: {[new_uuid]}', level=logging.ERROR, fg="red")
+					log(f'get_partition(): {self.blockdevice.get_partition}', level=logging.ERROR, fg="red")
+					raise err
+
+				# Partition.size doesn't wait for the kernel/udev to publish the partition, so it's done here
+				if wait_for_devices(lambda: partition.inventory_info.get('size'), device_deadline()) is None:
+					raise DiskError(f"The size of the new partition {partition.path} never showed up on {self}.")
+
+				return partition
 			else:
 				log("Add partition is exiting due to excessive wait time", level=logging.ERROR, fg="red")
 				raise DiskError(f"New partition never showed up after adding new partition on {self}.")
@@ -238,9 +334,20 @@ class Filesystem:
 		# TODO: This should never be able to happen
 		log(f"Could not find the new PARTUUID after adding the partition.", level=logging.ERROR, fg="red")
 		log(f"Previous partitions: {previous_partition_uuids}", level=logging.ERROR, fg="red")
-		log(f"New partitions: {(previous_partition_uuids ^ {partition.uuid for partition in self.blockdevice.partitions.values()})}", level=logging.ERROR, fg="red")
+		log(f"New partitions: {(previous_partition_uuids ^ self._partition_uuids())}", level=logging.ERROR, fg="red")
 		raise DiskError(f"Could not add partition using: {parted_string}")
 
+	def _partition_uuids(self) -> Set[str]:
+		uuids = set()
+		for partition in self.blockdevice.partitions.values():
+			try:
+				uuids.add(partition.uuid)
+			except DiskError:
+				# Not visible yet, the kernel or udev is still catching up
+				pass
+
+		return uuids
+
 	def set_name(self, partition: int, name: str) -> bool:
 		return self.parted(f'{self.blockdevice.device} name {partition + 1} "{name}"') == 0
 
@@ -256,8 +363,46 @@ class Filesystem:
 		except:
 			pass
 
-		self.partprobe()
+		self.partprobe('Filesystem.parted_mklabel()')
 		worked = self.raw_parted(f'{device} mklabel {disk_label}').exit_code == 0
-		self.partprobe()
+		self.partprobe('Filesystem.parted_mklabel()')
 
 		return worked
+
+
+def load_layouts(layouts :Dict[BlockDevice, Dict[str, Any]], mode :int, max_workers :Optional[int] = None) -> None:
+	"""
+	Runs :py:meth:`Filesystem.load_layout` for several disks at the same time, since partitioning,
+	encrypting and formatting one disk doesn't have to wait for another. Everything on a disk still happens
+	in order, and everything logged while working on it is prefixed with the disk (see :py:func:`log_context`).
+
+	:param max_workers: How many disks to work on at once, defaults to ``storage['DISK_WORKERS']``.
+	:type max_workers: int, optional
+
+	Once every disk is done, a :ref:`DiskError` naming the disks that failed (if any) is raised, see :py:func:`run_per_device`.
+	"""
+	encrypted = [
+		partition.get('mountpoint') or blockdevice.path
+		for blockdevice, layout in layouts.items()
+		for partition in layout.get('partitions', [])
+		if partition.get('encrypted', False) and not partition.get('!password')
+	]
+	if encrypted and not storage['arguments'].get('!encryption-password'):
+		# Asked once up front, whether there's one disk or several: the workers can't all prompt for it at once
+		if storage['arguments'].get('silent', False):
+			raise ValueError(f"Missing encryption password for {', '.join(encrypted)}")
+
+		from ..user_interaction import get_password
+
+		prompt = str(_('Enter a encryption password for {}').format(', '.join(encrypted)))
+		storage['arguments']['!encryption-password'] = get_password(prompt)
+
+	def load_layout(blockdevice :BlockDevice, layout :Dict[str, Any]) -> None:
+		with Filesystem(blockdevice, mode) as fs:
+			fs.load_layout(layout)
+
+	run_per_device(
+		{blockdevice.path: functools.partial(load_layout, blockdevice, layout) for blockdevice, layout in layouts.items()},
+		'set up',
+		max_workers
+	)
@@ -4,24 +4,77 @@ import logging
 import os  # type: ignore
 import pathlib
 import re
-import time
-import glob
-from typing import Union, List, Iterator, Dict, Optional, Any, TYPE_CHECKING
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Union, List, Iterator, Dict, Optional, Any, Tuple, TYPE_CHECKING
 # https://stackoverflow.com/a/39757388/929999
 if TYPE_CHECKING:
 	from .partition import Partition
 
-from .blockdevice import BlockDevice
+from .blockdevice import BlockDevice, record_rescan
 from .dmcryptdev import DMCryptDev
 from .mapperdev import MapperDev
+from .inventory import device_inventory
+from .monitor import device_deadline, settle_devices, wait_for_devices
+from .mounttable import mount_table
+from .udev import udev_blkid_information, udev_database_entry
 from ..exceptions import SysCallError, DiskError
-from ..general import SysCommand
-from ..output import log
+from ..general import SysCommand, run_many
+from ..output import log, log_context
+from ..replay import glob_paths, path_exists, read_file, real_path, recorded
 from ..storage import storage
 
 ROOT_DIR_PATTERN = re.compile('^.*?/devices')
 GIGA = 2 ** 30
 
+def run_per_device(tasks :Dict[str, Callable[[], Any]], action :str, max_workers :Optional[int] = None) -> None:
+	"""
+	Runs independent work on several devices (``{path: task}``) on at most ``max_workers`` threads,
+	defaulting to ``storage['DISK_WORKERS']``. Everything a task logs is prefixed with its device (see :py:func:`log_context`).
+
+	Once every task is done, a :ref:`DiskError` naming the devices that failed to ``action`` (if any) is raised.
+	With a single worker or task they're simply run in order, and the first failure is raised as is.
+	"""
+	if max_workers is None:
+		max_workers = storage.get('DISK_WORKERS', 1)
+
+	max_workers = max(1, min(max_workers, len(tasks)))
+
+	if max_workers == 1:
+		for task in tasks.values():
+			task()
+		return
+
+	def run(path :str, task :Callable[[], Any]) -> None:
+		with log_context(path):
+			try:
+				task()
+			except BaseException as error:
+				log(f"Could not {action} {path}: {error!r}", level=logging.ERROR, fg="red")
+				raise
+
+	log(f"Going to {action} {', '.join(tasks)} using {max_workers} workers", level=logging.INFO)
+
+	executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='device')
+	futures = {}
+	try:
+		for path, task in tasks.items():
+			futures[path] = executor.submit(run, path, task)
+
+		failures = {}
+		for path, future in futures.items():
+			if (error := future.exception()) is not None:
+				failures[path] = error
+	finally:
+		# Devices that haven't been started on yet are left alone if we're interrupted
+		for future in futures.values():
+			future.cancel()
+		executor.shutdown(wait=True)
+
+	if failures:
+		first_failure = next(iter(failures.values()))
+		raise DiskError(f"Could not {action} {', '.join(f'{path} ({error!r})' for path, error in failures.items())}") from first_failure
+
 def convert_size_to_gb(size :Union[int, float]) -> float:
 	return round(size / GIGA,1)
 
@@ -117,15 +170,21 @@ def blkid(cmd :str) -> Dict[str, Any]:
 		cmd += ' -o export'
 
 	try:
-		raw_data = SysCommand(cmd).decode()
+		raw_data = SysCommand(cmd, mode='pipe').decode()
 	except SysCallError as error:
 		log(f"Could not get block device information using blkid() using command {cmd}", level=logging.DEBUG)
 		raise error
 
+	return parse_blkid_export(raw_data)
+
+def parse_blkid_export(raw_data :str) -> Dict[str, Any]:
+	"""
+	Parses the output of ``blkid -o export`` into a dictionary keyed by device path.
+	"""
 	result = {}
 	# Process the raw result
 	devname = None
-	for line in raw_data.split('\r\n'):
+	for line in raw_data.split('\n'):
 		if not len(line):
 			devname = None
 			continue
@@ -145,7 +204,7 @@ def blkid(cmd :str) -> Dict[str, Any]:
 	return result
 
 def get_loop_info(path :str) -> Dict[str, Any]:
-	for drive in json.loads(SysCommand(['losetup', '--json']).decode('UTF_8'))['loopdevices']:
+	for drive in json.loads(SysCommand(['losetup', '--json'], mode='pipe').decode('UTF_8'))['loopdevices']:
 		if not drive['name'] == path:
 			continue
 
@@ -167,12 +226,10 @@ def enrich_blockdevice_information(information :Dict[str, Any]) -> Dict[str, Any
 	for device_path, device_information in information.items():
 		dev_name = pathlib.Path(device_information['PATH']).name
 		if not device_information.get('TYPE') or not device_information.get('DEVTYPE'):
-			with open(f"/sys/class/block/{dev_name}/uevent") as fh:
-				device_information.update(uevent(fh.read()))
+			device_information.update(uevent(read_file(f"/sys/class/block/{dev_name}/uevent")))
 
-		if (dmcrypt_name := pathlib.Path(f"/sys/class/block/{dev_name}/dm/name")).exists():
-			with dmcrypt_name.open('r') as fh:
-				device_information['DMCRYPT_NAME'] = fh.read().strip()
+		if path_exists(dmcrypt_name := f"/sys/class/block/{dev_name}/dm/name"):
+			device_information['DMCRYPT_NAME'] = read_file(dmcrypt_name).strip()
 
 		result[device_path] = device_information
 
@@ -190,8 +247,7 @@ def uevent(data :str) -> Dict[str, Any]:
 
 def get_blockdevice_uevent(dev_name :str) -> Dict[str, Any]:
 	device_information = {}
-	with open(f"/sys/class/block/{dev_name}/uevent") as fh:
-		device_information.update(uevent(fh.read()))
+	device_information.update(uevent(read_file(f"/sys/class/block/{dev_name}/uevent")))
 
 	return {
 		f"/dev/{dev_name}" : {
@@ -213,28 +269,50 @@ def all_blockdevices(mappers=False, partitions=False, error=False) -> Dict[str,
 	from .partition import Partition
 
 	instances = {}
+	partition_information = {}
 
 	# Due to lsblk being highly unreliable for this use case,
 	# we'll iterate the /sys/class definitions and find the information
-	# from there.
-	for block_device in glob.glob("/sys/class/block/*"):
-		device_path = f"/dev/{pathlib.Path(block_device).readlink().name}"
-		try:
-			information = blkid(f'blkid -p -o export {device_path}')
-
-		# TODO: No idea why F841 is raised here:
-		except SysCallError as error: # noqa: F841
-			if error.exit_code in (512, 2):
-				# Assume that it's a loop device, and try to get info on it
-				try:
-					information = get_loop_info(device_path)
-					if not information:
-						raise SysCallError("Could not get loop information", exit_code=1)
-
-				except SysCallError:
-					information = get_blockdevice_uevent(pathlib.Path(block_device).readlink().name)
-			else:
-				raise error
+	# from there. Like the files read below, it's recorded and replayed along with the commands (see CommandRecorder).
+	block_devices = [pathlib.Path(block_device).name for block_device in glob_paths("/sys/class/block/*")]
+
+	# udev has already probed the devices, so reading its database is all it takes.
+	# Only the devices udev hasn't processed are probed with blkid, as a batch since the probes are independent.
+	udev_information = {dev_name: udev_blkid_information(dev_name) for dev_name in block_devices}
+	unprocessed = [dev_name for dev_name, information in udev_information.items() if information is None]
+	probes = dict(zip(unprocessed, run_many([['blkid', '-p', '-o', 'export', f"/dev/{dev_name}"] for dev_name in unprocessed], mode='pipe')))
+
+	for dev_name in block_devices:
+		device_path = f"/dev/{dev_name}"
+
+		if (information := udev_information[dev_name]) is not None:
+			# Same as blkid exiting with code 2, nothing was found on the device
+			exit_code = 0 if information else 2
+		else:
+			probe = probes[dev_name]
+			if probe.error:
+				raise probe.error
+
+			exit_code = probe.exit_code
+			if exit_code == 0:
+				information = parse_blkid_export(probe.decode())
+
+		if exit_code in (512, 2):
+			# Assume that it's a loop device, and try to get info on it
+			try:
+				if not path_exists(f"/sys/class/block/{dev_name}/loop/backing_file"):
+					# Not a loop device, or one that isn't set up, losetup wouldn't know anything about it
+					raise SysCallError("Could not get loop information", exit_code=1)
+
+				information = get_loop_info(device_path)
+				if not information:
+					raise SysCallError("Could not get loop information", exit_code=1)
+
+			except SysCallError:
+				information = get_blockdevice_uevent(dev_name)
+		elif exit_code != 0:
+			log(f"Could not get block device information using blkid() using command {probe.cmd}", level=logging.DEBUG)
+			raise SysCallError(f"{probe.cmd} exited with abnormal exit code [{probe.exit_code}]: {probe[-500:]}", probe.exit_code)
 
 		information = enrich_blockdevice_information(information)
 
@@ -243,7 +321,7 @@ def all_blockdevices(mappers=False, partitions=False, error=False) -> Dict[str,
 				instances[path] = DMCryptDev(dev_path=path)
 			elif path_info.get('PARTUUID') or path_info.get('PART_ENTRY_NUMBER'):
 				if partitions:
-					instances[path] = Partition(path, BlockDevice(get_parent_of_partition(pathlib.Path(path))))
+					partition_information[path] = path_info
 			elif path_info.get('PTTYPE', False) is not False or path_info.get('TYPE') == 'loop':
 				instances[path] = BlockDevice(path, path_info)
 			elif path_info.get('TYPE') == 'squashfs':
@@ -252,17 +330,45 @@ def all_blockdevices(mappers=False, partitions=False, error=False) -> Dict[str,
 			else:
 				log(f"Unknown device found by all_blockdevices(), ignoring: {information}", level=logging.WARNING, fg="yellow")
 
+	# Partitions share the BlockDevice() of their disk, rather than each one enumerating all devices again to create it
+	for path, path_info in partition_information.items():
+		parent_path = get_parent_of_partition(pathlib.Path(path))
+		if not isinstance(parent := instances.get(parent_path), BlockDevice):
+			parent = BlockDevice(parent_path)
+
+		instances[path] = Partition(path, parent)
+
 	if mappers:
-		for block_device in glob.glob("/dev/mapper/*"):
-			if (pathobj := pathlib.Path(block_device)).is_symlink():
+		for block_device in glob_paths("/dev/mapper/*"):
+			if recorded('is_symlink', block_device, (pathobj := pathlib.Path(block_device)).is_symlink):
 				instances[f"/dev/mapper/{pathobj.name}"] = MapperDev(mappername=pathobj.name)
 
 	return instances
 
 
+def partuuid_to_partition_number(disk :str, partuuid :str) -> Optional[int]:
+	"""
+	Returns the partition number (``/sys/class/block/<partition>/partition``) of the partition with ``partuuid`` on ``disk``,
+	or None if there isn't one (yet). The PARTUUID is read from the udev database, falling back on the :ref:`DeviceInventory`.
+	"""
+	disk_name = pathlib.Path(real_path(disk)).name
+	partuuid = partuuid.lower()
+
+	for partition_number_file in glob_paths(f"/sys/class/block/{disk_name}/{disk_name}*/partition"):
+		partition_name = pathlib.Path(partition_number_file).parent.name
+
+		if not (entry_uuid := (udev_database_entry(partition_name) or {}).get('ID_PART_ENTRY_UUID')):
+			entry_uuid = (device_inventory().get(f"/dev/{partition_name}") or {}).get('partuuid')
+
+		if entry_uuid and entry_uuid.lower() == partuuid:
+			return int(read_file(partition_number_file).strip())
+
+	return None
+
+
 def get_parent_of_partition(path :pathlib.Path) -> pathlib.Path:
 	partition_name = path.name
-	pci_device = (pathlib.Path("/sys/class/block") / partition_name).resolve()
+	pci_device = pathlib.Path(real_path(f"/sys/class/block/{partition_name}"))
 	return f"/dev/{pci_device.parent.name}"
 
 def harddrive(size :Optional[float] = None, model :Optional[str] = None, fuzzy :bool = False) -> Optional[BlockDevice]:
@@ -287,47 +393,37 @@ def split_bind_name(path :Union[pathlib.Path, str]) -> list:
 	return device_path,bind_path
 
 def find_mountpoint(device_path :str) -> Dict[str, Any]:
-	try:
-		for filesystem in json.loads(SysCommand(f'/usr/bin/findmnt -R --json {device_path}').decode())['filesystems']:
-			yield filesystem
-	except SysCallError:
-		return {}
+	for filesystem in mount_table().findmnt(device_path, recursive=True):
+		yield filesystem
 
 def get_mount_info(path :Union[pathlib.Path, str], traverse :bool = False, return_real_path :bool = False) -> Dict[str, Any]:
 	device_path, bind_path = split_bind_name(path)
-	output = {}
+	filesystems = []
 
 	for traversal in list(map(str, [str(device_path)] + list(pathlib.Path(str(device_path)).parents))):
-		try:
-			log(f"Getting mount information for device path {traversal}", level=logging.DEBUG)
-			if (output := SysCommand(f'/usr/bin/findmnt --json {traversal}').decode('UTF-8')):
-				break
-
-		except SysCallError as error:
-			print('ERROR:', error)
-			pass
+		log(f"Getting mount information for device path {traversal}", level=logging.DEBUG)
+		if (filesystems := mount_table().findmnt(traversal)):
+			break
 
 		if not traverse:
 			break
 
-	if not output:
+	if not filesystems:
 		raise DiskError(f"Could not get mount information for device path {device_path}")
 
-	output = json.loads(output)
-
 	# for btrfs partitions we redice the filesystem list to the one with the source equals to the parameter
 	# i.e. the subvolume filesystem we're searching for
-	if 'filesystems' in output and len(output['filesystems']) > 1 and bind_path is not None:
-		output['filesystems'] = [entry for entry in output['filesystems'] if entry['source'] == str(path)]
+	if len(filesystems) > 1 and bind_path is not None:
+		filesystems = [entry for entry in filesystems if entry['source'] == str(path)]
 
-	if 'filesystems' in output:
-		if len(output['filesystems']) > 1:
-			raise DiskError(f"Path '{device_path}' contains multiple mountpoints: {output['filesystems']}")
+	if filesystems:
+		if len(filesystems) > 1:
+			raise DiskError(f"Path '{device_path}' contains multiple mountpoints: {filesystems}")
 
 		if return_real_path:
-			return output['filesystems'][0], traversal
+			return filesystems[0], traversal
 		else:
-			return output['filesystems'][0]
+			return filesystems[0]
 
 	if return_real_path:
 		return {}, traversal
@@ -344,35 +440,69 @@ def get_all_targets(data :Dict[str, Any], filters :Dict[str, None] = {}) -> Dict
 
 	return filters
 
-def get_partitions_in_use(mountpoint :str) -> List[Partition]:
+
+# The mounted partitions and mappers by mountpoint, and the generations they were joined at
+_mounted_devices :Optional[Dict[str, Union[Partition, MapperDev]]] = None
+_mounted_devices_generation :Optional[Tuple[Any, ...]] = None
+_mounted_devices_lock = threading.Lock()
+
+def mounted_devices() -> Dict[str, Union[Partition, MapperDev]]:
+	"""
+	Returns the :ref:`Partition` or :ref:`MapperDev` mounted at every mountpoint, by joining the
+	:ref:`MountTable` with the :ref:`DeviceInventory`. It's only joined again once either of them changes.
+	"""
 	from .partition import Partition
 
-	try:
-		output = SysCommand(f"/usr/bin/findmnt --json -R {mountpoint}").decode('UTF-8')
-	except SysCallError:
-		return {}
+	global _mounted_devices, _mounted_devices_generation
 
-	if not output:
-		return {}
+	with _mounted_devices_lock:
+		table = mount_table()
+		table.refresh()
+		inventory = device_inventory()
 
-	output = json.loads(output)
-	# print(output)
+		if _mounted_devices is not None and _mounted_devices_generation == (inventory.generation, table.generation):
+			return _mounted_devices
 
-	mounts = {}
+		devices :Dict[str, Union[Partition, MapperDev]] = {}
+		block_devices :Dict[str, BlockDevice] = {}
+		mounts :Dict[str, Union[Partition, MapperDev]] = {}
 
-	block_devices_available = all_blockdevices(mappers=True, partitions=True, error=True)
+		for entry in table.entries:
+			if not entry.source.startswith('/dev/'):
+				continue
 
-	block_devices_mountpoints = {}
-	for blockdev in block_devices_available.values():
-		if not type(blockdev) in (Partition, MapperDev):
-			continue
+			if not (info := inventory.get(entry.source) or inventory.get(real_path(entry.source))):
+				continue
+
+			if (path := info['path']) not in devices:
+				if info.get('type') == 'part' and (parent_path := inventory.parent(path)):
+					if parent_path not in block_devices:
+						# sysfs has all BlockDevice() needs, without probing every device like all_blockdevices() would
+						parent_info, = get_blockdevice_uevent(pathlib.Path(parent_path).name).values()
+						block_devices[parent_path] = BlockDevice(parent_path, parent_info)
+					devices[path] = Partition(path, block_devices[parent_path])
+				elif path.startswith('/dev/mapper/'):
+					devices[path] = MapperDev(mappername=pathlib.Path(path).name)
+				else:
+					continue
+
+			mounts[entry.target] = devices[path]
 
-		for blockdev_mountpoint in blockdev.mount_information:
-			block_devices_mountpoints[blockdev_mountpoint['target']] = blockdev
+		_mounted_devices = mounts
+		_mounted_devices_generation = (inventory.generation, table.generation)
+		return _mounted_devices
+
+def get_partitions_in_use(mountpoint :str) -> List[Partition]:
+	if not (filesystems := mount_table().findmnt(mountpoint, recursive=True)):
+		return {}
+
+	mounts = {}
+
+	block_devices_mountpoints = mounted_devices()
 
 	log(f'Filtering available mounts {block_devices_mountpoints} to those under {mountpoint}', level=logging.DEBUG)
 
-	for mountpoint in list(get_all_targets(output['filesystems']).keys()):
+	for mountpoint in list(get_all_targets(filesystems, {}).keys()):
 		if mountpoint in block_devices_mountpoints:
 			if mountpoint not in mounts:
 				mounts[mountpoint] = block_devices_mountpoints[mountpoint]
@@ -389,17 +519,17 @@ def get_partitions_in_use(mountpoint :str) -> List[Partition]:
 def get_filesystem_type(path :str) -> Optional[str]:
 	device_name, bind_name = split_bind_name(path)
 	try:
-		return SysCommand(f"blkid -o value -s TYPE {device_name}").decode('UTF-8').strip()
+		return SysCommand(f"blkid -o value -s TYPE {device_name}", mode='pipe').decode('UTF-8').strip()
 	except SysCallError:
 		return None
 
 
 def disk_layouts() -> Optional[Dict[str, Any]]:
 	try:
-		if (handle := SysCommand("lsblk -f -o+TYPE,SIZE -J")).exit_code == 0:
+		if (handle := SysCommand("lsblk -f -o+TYPE,SIZE -J", mode='pipe')).exit_code == 0:
 			return {str(key): val for key, val in json.loads(handle.decode('UTF-8')).items()}
 		else:
-			log(f"Could not return disk layouts: {handle}", level=logging.WARNING, fg="yellow")
+			log(f"Could not return disk layouts: {handle.stderr.decode('UTF-8', errors='replace')}", level=logging.WARNING, fg="yellow")
 			return None
 	except SysCallError as err:
 		log(f"Could not return disk layouts: {err}", level=logging.WARNING, fg="yellow")
@@ -420,25 +550,29 @@ def find_partition_by_mountpoint(block_devices :List[BlockDevice], relative_moun
 			if partition.get('mountpoint', None) == relative_mountpoint:
 				return partition
 
-def partprobe() -> bool:
+def partprobe(requested_by :str = 'partprobe()') -> bool:
+	record_rescan('all devices', requested_by)
 	if SysCommand(f'bash -c "partprobe"').exit_code == 0:
-		time.sleep(5) # TODO: Remove, we should be relying on blkid instead of lsblk
+		settle_devices(device_deadline())
 		return True
 	return False
 
 def convert_device_to_uuid(path :str) -> str:
 	device_name, bind_name = split_bind_name(path)
-	for i in range(storage['DISK_RETRY_ATTEMPTS']):
-		partprobe()
 
+	def device_uuid() -> Optional[str]:
 		# TODO: Convert lsblk to blkid
 		# (lsblk supports BlockDev and Partition UUID grabbing, blkid requires you to pick PTUUID and PARTUUID)
-		output = json.loads(SysCommand(f"lsblk --json -o+UUID {device_name}").decode('UTF-8'))
+		output = json.loads(SysCommand(f"lsblk --json -o+UUID {device_name}", mode='pipe').decode('UTF-8'))
 
 		for device in output['blockdevices']:
 			if (dev_uuid := device.get('uuid', None)):
 				return dev_uuid
 
-		time.sleep(storage['DISK_TIMEOUTS'])
+	deadline = device_deadline()
+	partprobe('convert_device_to_uuid()')
+
+	if (dev_uuid := wait_for_devices(device_uuid, deadline)):
+		return dev_uuid
 
 	raise DiskError(f"Could not retrieve the UUID of {path} within a timely manner.")
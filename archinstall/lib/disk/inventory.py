@@ -0,0 +1,110 @@
+import json
+import logging
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from ..general import SysCommand
+from ..output import log
+from ..probe_cache import probe_cache
+
+
+class DeviceInventory:
+	"""
+	A snapshot of every block device on the system (disks, partitions, loop, dm and md devices),
+	taken with a single ``lsblk -J -b -O``. Sizes are in bytes.
+
+	Devices are indexed by their path (``/dev/mapper/root``) as well as their kernel name (``/dev/dm-0``).
+	Use :py:func:`device_inventory` to get the shared snapshot rather than scanning a new one.
+	"""
+	def __init__(self, blockdevices :List[Dict[str, Any]], generation :Optional[Tuple[int, int]] = None) -> None:
+		self.generation = generation
+		self._devices :Dict[str, Dict[str, Any]] = {}
+		self._paths :Dict[str, None] = {}
+		self._parents :Dict[str, str] = {}
+
+		self._index(blockdevices)
+
+	def __contains__(self, path :str) -> bool:
+		return path in self._devices
+
+	def __iter__(self) -> Iterator[str]:
+		return iter(self._paths)
+
+	def __len__(self) -> int:
+		return len(self._paths)
+
+	def __repr__(self) -> str:
+		return f"DeviceInventory({', '.join(self)})"
+
+	@classmethod
+	def scan(cls) -> 'DeviceInventory':
+		generation = probe_cache.generation
+		output = json.loads(SysCommand('lsblk -J -b -O', mode='pipe').decode('UTF-8'))
+
+		return cls(output.get('blockdevices', []), generation=generation)
+
+	def _index(self, blockdevices :List[Dict[str, Any]], parent :Optional[str] = None) -> None:
+		for device in blockdevices:
+			# A device with several parents (md, dm on multiple disks) is listed once under each of them
+			info = {key: value for key, value in device.items() if key != 'children'}
+			info['children'] = [child['path'] for child in device.get('children', [])]
+
+			self._paths[device['path']] = None
+			self._devices[device['path']] = info
+			self._devices[f"/dev/{device['kname']}"] = info
+			if parent:
+				self._parents.setdefault(device['path'], parent)
+
+			self._index(device.get('children', []), parent=device['path'])
+
+	def get(self, path :str) -> Optional[Dict[str, Any]]:
+		return self._devices.get(path)
+
+	def children(self, path :str) -> List[Dict[str, Any]]:
+		if not (info := self._devices.get(path)):
+			return []
+
+		return [self._devices[child] for child in info['children']]
+
+	def parent(self, path :str) -> Optional[str]:
+		"""
+		Returns the path of the device ``path`` lives on, /dev/sda for /dev/sda1 for instance.
+		"""
+		if not (info := self._devices.get(path)):
+			return None
+
+		return self._parents.get(info['path'])
+
+
+_inventory :Optional[DeviceInventory] = None
+_inventory_lock = threading.Lock()
+
+
+def device_inventory() -> DeviceInventory:
+	"""
+	Returns the shared :ref:`DeviceInventory` snapshot.
+	The snapshot is kept until a mutating command (``parted``, ``mkfs.*``, ``cryptsetup`` etc.) is executed,
+	changes made outside of archinstall require an explicit :py:func:`refresh_device_inventory`.
+	"""
+	global _inventory
+
+	with _inventory_lock:
+		if _inventory is None or _inventory.generation != probe_cache.generation:
+			_inventory = DeviceInventory.scan()
+
+		return _inventory
+
+
+def refresh_device_inventory() -> DeviceInventory:
+	"""
+	Takes a new :ref:`DeviceInventory` snapshot, for instance after a disk has been hot plugged.
+	"""
+	global _inventory
+
+	log('Refreshing the block device inventory', level=logging.DEBUG)
+	# Whatever changed behind our back has made the cached probes stale as well
+	probe_cache.clear()
+
+	with _inventory_lock:
+		_inventory = DeviceInventory.scan()
+		return _inventory
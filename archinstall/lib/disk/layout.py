@@ -0,0 +1,140 @@
+import math
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+# The units parted takes positions in, in bytes. A position without a unit is in MB, like in parted.
+UNITS = {
+	'b': 1,
+	'kb': 1000,
+	'mb': 1000 ** 2,
+	'gb': 1000 ** 3,
+	'tb': 1000 ** 4,
+	'kib': 1024,
+	'mib': 1024 ** 2,
+	'gib': 1024 ** 3,
+	'tib': 1024 ** 4,
+}
+# Partitions start on a MiB boundary, which is what parted and sfdisk align to as well
+ALIGNMENT = 1024 ** 2
+# The partition type ``parted mkpart <fs-type>`` sets, as an MBR type code and a GPT type (GUID or sfdisk shortcut).
+# Any other filesystem gets a Linux filesystem type (83 and L).
+MICROSOFT_BASIC_DATA = 'EBD0A0A2-B9E5-4433-87C0-68B6B72699C7'
+PARTITION_TYPES = {
+	'fat16': ('0e', MICROSOFT_BASIC_DATA),
+	'fat32': ('0c', MICROSOFT_BASIC_DATA),
+	'vfat': ('0c', MICROSOFT_BASIC_DATA),
+	'ntfs': ('07', MICROSOFT_BASIC_DATA),
+	'swap': ('82', 'S'),
+	'linux-swap': ('82', 'S'),
+}
+
+
+def position_to_sector(position :str, sector_size :int, device_size :int, end :bool = False) -> int:
+	"""
+	Converts a parted position (``512MiB``, ``50%`` or ``2048s``) on a disk of ``device_size`` bytes to a sector.
+	Ends are inclusive like in parted, so an end of ``512MiB`` is the sector right before 512MiB.
+
+	Raises ValueError for anything that can't be converted.
+	"""
+	if not (match := re.fullmatch(r'\s*([0-9]+(?:\.[0-9]+)?)\s*([a-zA-Z%]*)\s*', str(position))):
+		raise ValueError(f"Can not convert the position {position} to a sector")
+
+	value, unit = float(match.group(1)), match.group(2).lower() or 'mb'
+
+	if unit == 's':
+		return int(value)
+	elif unit == '%':
+		offset = device_size * value / 100
+	elif unit in UNITS:
+		offset = value * UNITS[unit]
+	else:
+		raise ValueError(f"Can not convert the position {position} to a sector, unknown unit {unit}")
+
+	if end:
+		return math.floor(offset / sector_size) - 1
+
+	# Never in front of the first MiB, where the partition table lives (parted turns 0% in to 1MiB as well)
+	return max(math.ceil(offset / ALIGNMENT), 1) * ALIGNMENT // sector_size
+
+
+def partition_type(partition :Dict[str, Any], label :str) -> str:
+	"""
+	Returns the sfdisk type of a layout entry, matching what ``parted mkpart`` and ``set <n> boot on`` end up with.
+	"""
+	if partition.get('boot', False) and label == 'gpt':
+		# On GPT, parted's boot flag is the EFI system partition type
+		return 'U'
+
+	mbr_type, gpt_type = PARTITION_TYPES.get(partition.get('filesystem', {}).get('format'), ('83', 'L'))
+	return gpt_type if label == 'gpt' else mbr_type
+
+
+def compile_layout(layout :Dict[str, Any], label :str, sector_size :int, device_size :int, default_start :str, existing_ends :Optional[Dict[str, int]] = None) -> Tuple[str, List[Dict[str, Any]]]:
+	"""
+	Compiles the partitions of a ``disk_layouts`` entry that are to be created (``wipe`` without a ``PARTUUID``)
+	into an ``sfdisk`` script, which writes them all at once. Existing partitions are left alone.
+
+	If the layout wipes the disk, the script creates a new ``label`` (``gpt`` or ``dos``) partition table,
+	otherwise the partitions are meant to be appended with ``sfdisk --append``.
+	The first partition starts at ``default_start`` unless the layout says otherwise, the others where the one before them ends.
+	For existing partitions that's looked up in ``existing_ends``, the sector right after each of them by their PARTUUID.
+
+	Returns the script and the layout entries in the order their partitions are created.
+	Raises ValueError if the layout can't be expressed as a script, in which case it's up to
+	:py:meth:`Filesystem.add_partition` to create them one by one.
+	"""
+	lines = []
+	if layout.get('wipe', False):
+		lines.append(f"label: {label}")
+		lines.append('')
+
+	entries = []
+	previous_end :Optional[int] = None
+	first = True
+
+	for partition in layout.get('partitions', []):
+		if not partition.get('wipe', False) or partition.get('PARTUUID', None):
+			# An existing partition, the next new one starts where it ends on the disk (if that's known)
+			if (end := (existing_ends or {}).get(partition.get('PARTUUID', None))) is not None:
+				previous_end = end - 1
+			else:
+				previous_end = None
+
+			first = False
+			continue
+
+		if partition.get('type', 'primary') != 'primary':
+			raise ValueError(f"Can not compile {partition.get('type')} partitions")
+
+		if partition.get('start'):
+			start = position_to_sector(partition['start'], sector_size, device_size)
+		elif previous_end is not None:
+			start = position_to_sector(f"{(previous_end + 1) * sector_size}B", sector_size, device_size)
+		elif first:
+			start = position_to_sector(default_start, sector_size, device_size)
+		else:
+			raise ValueError(f"Can not tell where the partition {partition} starts")
+
+		first = False
+
+		fields = [f"start={start}"]
+
+		# Like parted, "size" is where the partition ends
+		if (size := partition.get('size', '100%')) in ('100%', None):
+			# Whatever is left, which for GPT leaves room for the backup table
+			previous_end = None
+		else:
+			previous_end = position_to_sector(size, sector_size, device_size, end=True)
+			if previous_end < start:
+				raise ValueError(f"The partition {partition} ends before it starts")
+
+			fields.append(f"size={previous_end - start + 1}")
+
+		fields.append(f"type={partition_type(partition, label)}")
+		if partition.get('boot', False) and label == 'dos':
+			fields.append('bootable')
+
+		lines.append(', '.join(fields))
+		entries.append(partition)
+
+	return '\n'.join(lines) + '\n', entries
@@ -1,13 +1,13 @@
 import glob
 import pathlib
 import logging
-import json
 from dataclasses import dataclass
 from typing import Optional, List, Dict, Any, Iterator, TYPE_CHECKING
 
 from ..exceptions import SysCallError
 from ..general import SysCommand
 from ..output import log
+from .mounttable import mount_table
 
 if TYPE_CHECKING:
 	from .btrfs import BtrfsSubvolume
@@ -39,7 +39,7 @@ class MapperDev:
 					partition_belonging_to_dmcrypt_device = pathlib.Path(slave).name
 					
 					try:
-						uevent_data = SysCommand(f"blkid -o export /dev/{partition_belonging_to_dmcrypt_device}").decode()
+						uevent_data = SysCommand(f"blkid -o export /dev/{partition_belonging_to_dmcrypt_device}", mode='pipe').decode()
 					except SysCallError as error:
 						log(f"Could not get information on device /dev/{partition_belonging_to_dmcrypt_device}: {error}", level=logging.ERROR, fg="red")
 					
@@ -52,17 +52,7 @@ class MapperDev:
 
 	@property
 	def mountpoint(self) -> Optional[str]:
-		try:
-			data = json.loads(SysCommand(f"findmnt --json -R {self.path}").decode())
-			for filesystem in data['filesystems']:
-				return filesystem.get('target')
-
-		except SysCallError as error:
-			# Not mounted anywhere most likely
-			log(f"Could not locate mount information for {self.path}: {error}", level=logging.WARNING, fg="yellow")
-			pass
-
-		return None
+		return mount_table().mountpoint(self.path)
 
 	@property
 	def mount_information(self) -> List[Dict[str, Any]]:
@@ -0,0 +1,293 @@
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Optional, Set
+
+from .udev import udev_database_entry
+from ..output import log
+from ..probe_cache import probe_cache
+from ..replay import active_replay
+from ..storage import storage
+
+NETLINK_KOBJECT_UEVENT = 15
+# The multicast groups of NETLINK_KOBJECT_UEVENT: events straight from the kernel,
+# and the same events re-broadcast by udev once it's done processing them (rules run, /dev/disk/by-* links created).
+KERNEL_EVENTS = 1
+UDEV_EVENTS = 2
+UDEV_MONITOR_MAGIC = 0xfeedcafe
+
+UDEV_CONTROL = '/run/udev/control'
+# Exists for as long as udev has events queued, which is what `udevadm settle` waits for as well
+UDEV_QUEUE = '/run/udev/queue'
+KERNEL_SEQNUM = '/sys/kernel/uevent_seqnum'
+
+# How often conditions are checked when events can't be received
+POLL_INTERVAL = 0.1
+
+
+@dataclass
+class Uevent:
+	source :str
+	properties :Dict[str, str]
+
+	@classmethod
+	def parse(cls, data :bytes) -> Optional['Uevent']:
+		"""
+		Parses a kernel (``add@/devices/...\\0ACTION=add\\0...``) or udev (``libudev\\0<header>KEY=value\\0...``) message.
+		"""
+		if data.startswith(b'libudev\0'):
+			if len(data) < 24:
+				return None
+
+			magic, header_size, properties_offset, properties_length = struct.unpack_from('=IIII', data, 8)
+			if socket.ntohl(magic) != UDEV_MONITOR_MAGIC:
+				return None
+
+			source = 'udev'
+			payload = data[properties_offset:properties_offset + properties_length]
+		elif b'@' in data.split(b'\0', 1)[0]:
+			source = 'kernel'
+			payload = data.split(b'\0', 1)[1] if b'\0' in data else b''
+		else:
+			return None
+
+		properties = {}
+		for item in payload.decode('UTF-8', errors='replace').split('\0'):
+			if '=' in item:
+				key, val = item.split('=', 1)
+				properties[key] = val
+
+		return cls(source=source, properties=properties)
+
+	@property
+	def action(self) -> Optional[str]:
+		return self.properties.get('ACTION')
+
+	@property
+	def devname(self) -> Optional[str]:
+		return self.properties.get('DEVNAME')
+
+	@property
+	def seqnum(self) -> int:
+		return int(self.properties.get('SEQNUM', 0))
+
+
+def udev_running() -> bool:
+	return os.path.exists(UDEV_CONTROL)
+
+
+def _kernel_seqnum() -> int:
+	try:
+		with open(KERNEL_SEQNUM) as fh:
+			return int(fh.read().strip())
+	except (OSError, ValueError):
+		return 0
+
+
+class UeventMonitor:
+	"""
+	Listens for device events (``NETLINK_KOBJECT_UEVENT``) in a background thread, so that waiting for
+	something to happen to a disk returns as soon as it happened rather than after a fixed sleep.
+
+	The events only tell us *when* to look again, the conditions passed to :py:meth:`wait_for` check the actual state.
+	Every block device event also marks the cached probes of that disk as stale (see :ref:`ProbeCache`),
+	since lsblk and blkid can have run before udev was done with the device.
+
+	Use :py:func:`uevent_monitor` to get the shared monitor rather than starting a new one.
+	"""
+	def __init__(self) -> None:
+		self._socket :Optional[socket.socket] = None
+		self._condition = threading.Condition()
+		self._events = 0
+		self._udev_seqnum = 0
+		self.udev = udev_running()
+
+		try:
+			self._socket = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC, NETLINK_KOBJECT_UEVENT)
+			try:
+				# A partprobe of a disk with many partitions causes a burst of events
+				self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+			except OSError:
+				pass
+			self._socket.bind((0, UDEV_EVENTS if self.udev else KERNEL_EVENTS))
+		except (AttributeError, OSError) as error:
+			log(f"Can not listen for device events, will poll instead: {error}", level=logging.DEBUG)
+			if self._socket:
+				self._socket.close()
+			self._socket = None
+
+		if self.udev and not os.path.exists(UDEV_QUEUE):
+			# Anything that happened before we started listening has already been processed
+			self._udev_seqnum = _kernel_seqnum()
+
+		if self._socket:
+			threading.Thread(target=self._receive, name='uevent-monitor', daemon=True).start()
+
+	@property
+	def listening(self) -> bool:
+		return self._socket is not None
+
+	def _receive(self) -> None:
+		while True:
+			try:
+				data = self._socket.recv(128 * 1024)
+			except OSError as error:
+				# ENOBUFS means events were lost, which is still a reason for waiters to look again
+				log(f"Error receiving device events: {error}", level=logging.DEBUG)
+				probe_cache.invalidate()
+				with self._condition:
+					if self.udev and not os.path.exists(UDEV_QUEUE):
+						self._udev_seqnum = max(self._udev_seqnum, _kernel_seqnum())
+					self._events += 1
+					self._condition.notify_all()
+				continue
+
+			if not (event := Uevent.parse(data)):
+				continue
+
+			if event.properties.get('SUBSYSTEM') == 'block' and event.devname:
+				devname = event.devname if event.devname.startswith('/dev/') else f"/dev/{event.devname}"
+				probe_cache.invalidate(['uevent', devname])
+
+			with self._condition:
+				if event.source == 'udev':
+					self._udev_seqnum = max(self._udev_seqnum, event.seqnum)
+				self._events += 1
+				self._condition.notify_all()
+
+	def wait_for(self, condition :Callable[[], Any], deadline :float) -> Any:
+		"""
+		Waits until ``condition()`` returns something truthy, checking it again every time a device event is received.
+		Returns what the condition returned last, which is falsy if ``deadline`` (in :py:func:`time.monotonic` time) passed.
+
+		Probes the condition runs are never answered from the :ref:`ProbeCache` on a second look,
+		whatever they got the first time may have been from before the device was there.
+		Only the disks those probes looked at are expired, the rest of the cache is left alone.
+		"""
+		if active_replay():
+			# The commands aren't executed, so nothing is going to happen to the devices of this machine
+			return condition()
+
+		probed :Set[str] = set()
+		while True:
+			with self._condition:
+				seen = self._events
+
+			if probed:
+				probe_cache.expire(probed)
+
+			with probe_cache.tracking() as probed:
+				result = condition()
+
+			if result or (remaining := deadline - time.monotonic()) <= 0:
+				return result
+
+			with self._condition:
+				if self._socket is None:
+					self._condition.wait(min(remaining, POLL_INTERVAL))
+				else:
+					self._condition.wait_for(lambda: self._events != seen, timeout=remaining)
+
+	def settle(self, deadline :float) -> bool:
+		"""
+		Waits until udev has processed every event the kernel has sent so far, like ``udevadm settle``.
+		"""
+		if not self.udev:
+			return True
+
+		target = _kernel_seqnum()
+
+		def settled() -> bool:
+			if os.path.exists(UDEV_QUEUE):
+				return False
+
+			with self._condition:
+				if not self._udev_seqnum:
+					# We started while udev had a queue and no udev event has arrived since, so there's
+					# nothing to compare with. The queue being gone means it's done with what was in it.
+					self._udev_seqnum = _kernel_seqnum()
+					return True
+
+				return self._socket is None or self._udev_seqnum >= target
+
+		if not (result := self.wait_for(settled, deadline)):
+			log(f"udev didn't finish processing device events in time", level=logging.DEBUG)
+
+		return result
+
+
+_monitor :Optional[UeventMonitor] = None
+_monitor_lock = threading.Lock()
+
+
+def uevent_monitor() -> UeventMonitor:
+	"""
+	Returns the shared :ref:`UeventMonitor`, starting it if it isn't running yet.
+	"""
+	global _monitor
+
+	with _monitor_lock:
+		if _monitor is None:
+			_monitor = UeventMonitor()
+
+		return _monitor
+
+
+def device_deadline(seconds :Optional[float] = None) -> float:
+	"""
+	Returns the deadline to give the waits, ``seconds`` from now.
+	Defaults to ``DISK_RETRY_ATTEMPTS * DISK_TIMEOUTS``, the time disk operations have always been given.
+	"""
+	if seconds is None:
+		seconds = storage['DISK_RETRY_ATTEMPTS'] * storage['DISK_TIMEOUTS']
+
+	return time.monotonic() + seconds
+
+
+def wait_for_devices(condition :Callable[[], Any], deadline :float) -> Any:
+	"""
+	Waits until ``condition()`` is truthy, see :py:meth:`UeventMonitor.wait_for`.
+	"""
+	return uevent_monitor().wait_for(condition, deadline)
+
+
+def settle_devices(deadline :float) -> bool:
+	"""
+	Waits until udev is done processing device events, see :py:meth:`UeventMonitor.settle`.
+	"""
+	return uevent_monitor().settle(deadline)
+
+
+def wait_for_partition(path :str, deadline :float) -> bool:
+	"""
+	Waits until the partition (or any block device) ``path`` exists and udev has processed it.
+	"""
+	name = os.path.basename(path)
+	monitor = uevent_monitor()
+
+	def appeared() -> bool:
+		if not os.path.exists(f'/sys/class/block/{name}'):
+			return False
+
+		return not monitor.udev or udev_database_entry(name) is not None
+
+	return monitor.wait_for(appeared, deadline)
+
+
+def wait_for_uuid(uuid :str, deadline :float) -> bool:
+	"""
+	Waits until udev has made a file system UUID or PARTUUID visible as a ``/dev/disk/by-uuid`` or ``by-partuuid`` link.
+	Returns True straight away without udev, since nothing would ever create the links.
+	"""
+	monitor = uevent_monitor()
+	if not monitor.udev:
+		return True
+
+	def visible() -> bool:
+		return os.path.exists(f'/dev/disk/by-uuid/{uuid}') or os.path.exists(f'/dev/disk/by-partuuid/{uuid.lower()}')
+
+	return monitor.wait_for(visible, deadline)
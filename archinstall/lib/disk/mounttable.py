@@ -0,0 +1,293 @@
+import logging
+import os
+import re
+import select
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional
+
+from ..output import log
+from ..replay import active_recorder, active_replay, real_path, recorded
+
+MOUNTINFO = '/proc/self/mountinfo'
+
+
+def _unescape(value :str) -> str:
+	# The kernel escapes space, tab, newline and backslash as octal (\040 for a space)
+	return re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), value)
+
+
+def _split_bind_name(path :str) -> List[Optional[str]]:
+	# Same as helpers.split_bind_name(), which can't be imported from here
+	if '[' in path:
+		device_path, bind_path = path.split('[', 1)
+		return [device_path, bind_path.rstrip(']').strip()]
+
+	return [path, None]
+
+
+@dataclass
+class MountEntry:
+	"""
+	One line of ``/proc/self/mountinfo``, see ``man 5 proc`` for the meaning of the fields.
+	"""
+	mount_id :int
+	parent_id :int
+	major_minor :str
+	root :str
+	target :str
+	fstype :str
+	source :str
+	options :str
+
+	@classmethod
+	def parse(cls, line :str) -> 'MountEntry':
+		fields = line.split(' ')
+		# A variable amount of optional fields (shared:1, master:2 etc.) are terminated by a single -
+		separator = fields.index('-', 6)
+		mount_options, super_options = fields[5], fields[separator + 3]
+
+		options = mount_options.split(',')
+		options += [option for option in super_options.split(',') if option not in options]
+
+		return cls(
+			mount_id=int(fields[0]),
+			parent_id=int(fields[1]),
+			major_minor=fields[2],
+			root=_unescape(fields[3]),
+			target=_unescape(fields[4]),
+			fstype=fields[separator + 1],
+			source=_unescape(fields[separator + 2]),
+			options=','.join(options)
+		)
+
+	@property
+	def subvolume(self) -> Optional[str]:
+		"""
+		The btrfs subvolume (``subvol=``) or bind mounted directory the mount shows,
+		or None if it's the root of the file system.
+		"""
+		if self.fstype == 'btrfs':
+			for option in self.options.split(','):
+				if option.startswith('subvol='):
+					return option[len('subvol='):] if option != 'subvol=/' else None
+
+		return self.root if self.root != '/' else None
+
+	@property
+	def bind_source(self) -> str:
+		"""
+		The source in the ``/dev/sda2[/@home]`` notation ``findmnt`` and :ref:`Partition` use for subvolumes and bind mounts.
+		"""
+		if subvolume := self.subvolume:
+			return f"{self.source}[{subvolume}]"
+
+		return self.source
+
+
+class MountTable:
+	"""
+	The mounts of the system, parsed from ``/proc/self/mountinfo`` and indexed by source, target and ``major:minor``.
+	The file is only read again after the kernel signals (through ``poll()``) that something was mounted or unmounted,
+	so looking mounts up is as cheap as a dictionary lookup.
+
+	Use :py:func:`mount_table` to get the shared table rather than parsing a new one.
+	"""
+	def __init__(self, path :str = MOUNTINFO) -> None:
+		self.path = path
+		# Bumped every time the table is read, for anything derived from it to tell when it's stale
+		self.generation = 0
+		self.entries :List[MountEntry] = []
+		self._by_id :Dict[int, MountEntry] = {}
+		self._by_source :Dict[str, List[MountEntry]] = {}
+		self._by_target :Dict[str, List[MountEntry]] = {}
+		self._by_major_minor :Dict[str, List[MountEntry]] = {}
+		self._children :Dict[int, List[MountEntry]] = {}
+		self._lock = threading.Lock()
+
+		self._fd = os.open(path, os.O_RDONLY)
+		try:
+			self._poller :Optional[select.poll] = select.poll()
+			self._poller.register(self._fd, select.POLLPRI | select.POLLERR)
+		except (AttributeError, OSError):
+			# Without poll() there's no telling when it changed, so it's read on every lookup
+			self._poller = None
+
+		self._read()
+
+	def __del__(self) -> None:
+		if getattr(self, '_fd', None) is not None:
+			os.close(self._fd)
+			self._fd = None
+
+	def __iter__(self) -> Iterator[MountEntry]:
+		self.refresh()
+		return iter(self.entries)
+
+	def __len__(self) -> int:
+		self.refresh()
+		return len(self.entries)
+
+	def __repr__(self) -> str:
+		return f"MountTable({', '.join(entry.target for entry in self.entries)})"
+
+	@property
+	def changed(self) -> bool:
+		if self._poller is None or active_recorder() or active_replay():
+			# Every read is recorded (or replayed), what the machine's own mount table does in between doesn't matter
+			return True
+
+		return bool(self._poller.poll(0))
+
+	def refresh(self, force :bool = False) -> bool:
+		"""
+		Reads the mount table again if it has changed since it was last read (or ``force`` is given).
+		Returns True if it was read.
+		"""
+		with self._lock:
+			if not force and not self.changed:
+				return False
+
+			self._read()
+			return True
+
+	def _read_mountinfo(self) -> str:
+		os.lseek(self._fd, 0, os.SEEK_SET)
+		chunks = []
+		while (chunk := os.read(self._fd, 65536)):
+			chunks.append(chunk)
+
+		return b''.join(chunks).decode('UTF-8', errors='replace')
+
+	def _read(self) -> None:
+		entries = []
+		for line in recorded('read', self.path, self._read_mountinfo).split('\n'):
+			if not line:
+				continue
+
+			try:
+				entries.append(MountEntry.parse(line))
+			except (ValueError, IndexError):
+				log(f"Could not parse mount information: {line}", level=logging.DEBUG)
+
+		by_source :Dict[str, List[MountEntry]] = {}
+		by_target :Dict[str, List[MountEntry]] = {}
+		by_major_minor :Dict[str, List[MountEntry]] = {}
+		children :Dict[int, List[MountEntry]] = {}
+
+		for entry in entries:
+			by_source.setdefault(entry.source, []).append(entry)
+			if entry.source.startswith('/dev/') and (source_path := real_path(entry.source)) != entry.source:
+				# /dev/mapper/root and /dev/dm-0 are the same thing
+				by_source.setdefault(source_path, []).append(entry)
+
+			by_target.setdefault(entry.target, []).append(entry)
+			by_major_minor.setdefault(entry.major_minor, []).append(entry)
+			children.setdefault(entry.parent_id, []).append(entry)
+
+		self.entries = entries
+		self._by_id = {entry.mount_id: entry for entry in entries}
+		self._by_source = by_source
+		self._by_target = by_target
+		self._by_major_minor = by_major_minor
+		self._children = children
+		self.generation += 1
+
+	def by_source(self, device_path :str) -> List[MountEntry]:
+		"""
+		Returns the mounts of ``device_path``, where ``/dev/sda2[/@home]`` only returns the mounts of that subvolume.
+		"""
+		self.refresh()
+
+		device_path, bind_name = _split_bind_name(str(device_path))
+
+		found :Dict[int, MountEntry] = {}
+		for entry in self._by_source.get(device_path, []) + self._by_source.get(real_path(device_path), []):
+			found[entry.mount_id] = entry
+
+		if major_minor := self._major_minor(device_path):
+			for entry in self._by_major_minor.get(major_minor, []):
+				found[entry.mount_id] = entry
+
+		entries = sorted(found.values(), key=lambda entry: entry.mount_id)
+		if bind_name:
+			entries = [entry for entry in entries if entry.subvolume == bind_name]
+
+		return entries
+
+	def by_target(self, target :str) -> List[MountEntry]:
+		self.refresh()
+
+		target = str(target)
+		if target != '/':
+			target = target.rstrip('/')
+
+		return list(self._by_target.get(target, []))
+
+	def by_major_minor(self, major_minor :str) -> List[MountEntry]:
+		self.refresh()
+		return list(self._by_major_minor.get(major_minor, []))
+
+	def children(self, entry :MountEntry) -> List[MountEntry]:
+		return list(self._children.get(entry.mount_id, []))
+
+	def mountpoint(self, device_path :str) -> Optional[str]:
+		"""
+		Returns where ``device_path`` is mounted (the first place, if several), or None if it isn't.
+		"""
+		if entries := self.by_source(device_path):
+			return entries[0].target
+
+		return None
+
+	def findmnt(self, path :str, recursive :bool = False) -> List[Dict[str, Any]]:
+		"""
+		Returns the same as the ``filesystems`` list of ``findmnt --json [-R] <path>``,
+		where ``path`` is either a device or a mountpoint.
+		"""
+		found :Dict[int, MountEntry] = {}
+		for entry in self.by_source(path) + self.by_target(path):
+			found[entry.mount_id] = entry
+
+		return [self._json(entry, recursive) for entry in sorted(found.values(), key=lambda entry: entry.mount_id)]
+
+	def _json(self, entry :MountEntry, recursive :bool) -> Dict[str, Any]:
+		data :Dict[str, Any] = {
+			'target': entry.target,
+			'source': entry.bind_source,
+			'fstype': entry.fstype,
+			'options': entry.options
+		}
+
+		if recursive and (children := self.children(entry)):
+			data['children'] = [self._json(child, recursive) for child in children]
+
+		return data
+
+	def _major_minor(self, device_path :str) -> Optional[str]:
+		try:
+			device = recorded('rdev', device_path, lambda: os.stat(device_path).st_rdev)
+		except OSError:
+			return None
+
+		if not device:
+			return None
+
+		return f"{os.major(device)}:{os.minor(device)}"
+
+
+_mount_table :Optional[MountTable] = None
+_mount_table_lock = threading.Lock()
+
+
+def mount_table() -> MountTable:
+	"""
+	Returns the shared :ref:`MountTable`, which keeps itself up to date.
+	"""
+	global _mount_table
+
+	with _mount_table_lock:
+		if _mount_table is None:
+			_mount_table = MountTable()
+
+		return _mount_table
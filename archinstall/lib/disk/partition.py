@@ -7,13 +7,16 @@ import os
 import hashlib
 from typing import Optional, Dict, Any, List, Union, Iterator
 
-from .blockdevice import BlockDevice
+from .blockdevice import BlockDevice, record_rescan
 from .helpers import find_mountpoint, get_filesystem_type, convert_size_to_gb, split_bind_name
 from ..storage import storage
 from ..exceptions import DiskError, SysCallError, UnknownFilesystemFormat
 from ..output import log
 from ..general import SysCommand
 from .btrfs import get_subvolumes_from_findmnt, BtrfsSubvolume
+from .inventory import device_inventory
+from .monitor import device_deadline, settle_devices, wait_for_devices
+from .mounttable import mount_table
 
 class Partition:
 	def __init__(self,
@@ -35,25 +38,21 @@ class Partition:
 		self.path = path
 		self.part_id = part_id
 		self.target_mountpoint = mountpoint
-		self.filesystem = filesystem
+		# The file system type is only looked up once it's asked for,
+		# so that listing partitions doesn't cost a blkid per partition.
+		self._filesystem = filesystem
+		self._autodetect_filesystem = autodetect_filesystem and not filesystem
+		self._mount_information :Optional[List[Dict[str, Any]]] = None
 		self._encrypted = None
 		self.encrypted = encrypted
 		self.allow_formatting = False
 
+		if filesystem == 'crypto_LUKS':
+			self.encrypted = True
+
 		if mountpoint:
 			self.mount(mountpoint)
 
-		try:
-			self.mount_information = list(find_mountpoint(self.path))
-		except DiskError:
-			self.mount_information = [{}]
-
-		if not self.filesystem and autodetect_filesystem:
-			self.filesystem = get_filesystem_type(path)
-
-		if self.filesystem == 'crypto_LUKS':
-			self.encrypted = True
-
 	def __lt__(self, left_comparitor :BlockDevice) -> bool:
 		if type(left_comparitor) == Partition:
 			left_comparitor = left_comparitor.path
@@ -70,7 +69,7 @@ class Partition:
 		elif self.target_mountpoint:
 			mount_repr = f", rel_mountpoint={self.target_mountpoint}"
 
-		if self._encrypted:
+		if self.encrypted:
 			return f'Partition(path={self.path}, size={self.size}, PARTUUID={self._safe_uuid}, parent={self.real_device}, fs={self.filesystem}{mount_repr})'
 		else:
 			return f'Partition(path={self.path}, size={self.size}, PARTUUID={self._safe_uuid}, fs={self.filesystem}{mount_repr})'
@@ -83,7 +82,7 @@ class Partition:
 			'boot': self.boot,
 			'ESP': self.boot,
 			'mountpoint': self.target_mountpoint,
-			'encrypted': self._encrypted,
+			'encrypted': self.encrypted,
 			'start': self.start,
 			'size': self.end,
 			'filesystem': {
@@ -92,96 +91,90 @@ class Partition:
 		}
 
 	@property
-	def mountpoint(self) -> Optional[str]:
-		try:
-			data = json.loads(SysCommand(f"findmnt --json -R {self.path}").decode())
-			for filesystem in data['filesystems']:
-				return filesystem.get('target')
+	def filesystem(self) -> Optional[str]:
+		if self._autodetect_filesystem:
+			self._autodetect_filesystem = False
 
-		except SysCallError as error:
-			# Not mounted anywhere most likely
-			log(f"Could not locate mount information for {self.path}: {error}", level=logging.DEBUG)
-			pass
+			# lsblk (and there for the inventory) only knows what udev has probed, blkid asks the device itself
+			if not (filesystem := self.inventory_info.get('fstype')):
+				filesystem = get_filesystem_type(self.path)
+
+			self._filesystem = filesystem
+			if filesystem == 'crypto_LUKS':
+				self._encrypted = True
+
+		return self._filesystem
 
-		return None
+	@filesystem.setter
+	def filesystem(self, value :Optional[str]) -> None:
+		self._autodetect_filesystem = False
+		self._filesystem = value
 
 	@property
-	def sector_size(self) -> Optional[int]:
-		output = json.loads(SysCommand(f"lsblk --json -o+LOG-SEC {self.device_path}").decode('UTF-8'))
+	def mount_information(self) -> List[Dict[str, Any]]:
+		if self._mount_information is not None:
+			return self._mount_information
+
+		return list(find_mountpoint(self.path))
 
-		for device in output['blockdevices']:
-			return device.get('log-sec', None)
+	@mount_information.setter
+	def mount_information(self, value :List[Dict[str, Any]]) -> None:
+		self._mount_information = value
 
 	@property
-	def start(self) -> Optional[str]:
-		output = json.loads(SysCommand(f"sfdisk --json {self.block_device.path}").decode('UTF-8'))
+	def mountpoint(self) -> Optional[str]:
+		return mount_table().mountpoint(self.path)
+
+	@property
+	def inventory_info(self) -> Dict[str, Any]:
+		"""
+		Returns what the shared :ref:`DeviceInventory` snapshot knows about this partition (``lsblk -O`` columns),
+		or an empty dictionary if it doesn't exist (yet).
+		"""
+		return device_inventory().get(self.device_path) or {}
+
+	@property
+	def sector_size(self) -> Optional[int]:
+		return self.inventory_info.get('log-sec', None)
 
-		for partition in output.get('partitiontable', {}).get('partitions', []):
-			if partition['node'] == self.path:
-				return partition['start']  # * self.sector_size
+	@property
+	def start(self) -> Optional[str]:
+		if partition := self.block_device.partition_table.get(self.path):
+			return partition['start']  # * self.sector_size
 
 	@property
 	def end(self) -> Optional[str]:
 		# TODO: actually this is size in sectors unit
 		# TODO: Verify that the logic holds up, that 'size' is the size without 'start' added to it.
-		output = json.loads(SysCommand(f"sfdisk --json {self.block_device.path}").decode('UTF-8'))
-
-		for partition in output.get('partitiontable', {}).get('partitions', []):
-			if partition['node'] == self.path:
-				return partition['size']  # * self.sector_size
+		if partition := self.block_device.partition_table.get(self.path):
+			return partition['size']  # * self.sector_size
 
 	@property
 	def end_sectors(self) -> Optional[str]:
-		output = json.loads(SysCommand(f"sfdisk --json {self.block_device.path}").decode('UTF-8'))
-
-		for partition in output.get('partitiontable', {}).get('partitions', []):
-			if partition['node'] == self.path:
-				return partition['start'] + partition['size']
+		if partition := self.block_device.partition_table.get(self.path):
+			return partition['start'] + partition['size']
 
 	@property
 	def size(self) -> Optional[float]:
-		for i in range(storage['DISK_RETRY_ATTEMPTS']):
-			self.partprobe()
-
-			try:
-				lsblk = json.loads(SysCommand(f"lsblk --json -b -o+SIZE {self.device_path}").decode())
-
-				for device in lsblk['blockdevices']:
-					return convert_size_to_gb(device['size'])
-			except SysCallError as error:
-				if error.exit_code == 8192:
-					return None
-				else:
-					raise error
+		# Never waits, whoever just created the partition waits for the kernel/udev to publish it (see Filesystem.add_partition())
+		if (size := self.inventory_info.get('size')) is None:
+			# The partition doesn't exist
+			return None
 
-			time.sleep(storage['DISK_TIMEOUTS'])
+		return convert_size_to_gb(size)
 
 	@property
 	def boot(self) -> bool:
-		output = json.loads(SysCommand(f"sfdisk --json {self.block_device.path}").decode('UTF-8'))
-
-		# Get the bootable flag from the sfdisk output:
-		# {
-		#    "partitiontable": {
-		#       "device":"/dev/loop0",
-		#       "partitions": [
-		#          {"node":"/dev/loop0p1", "start":2048, "size":10483712, "type":"83", "bootable":true}
-		#       ]
-		#    }
-		# }
-
-		for partition in output.get('partitiontable', {}).get('partitions', []):
-			if partition['node'] == self.path:
-				return partition.get('bootable', False)
+		# Get the bootable flag from the partition table (sfdisk output):
+		#    {"node":"/dev/loop0p1", "start":2048, "size":10483712, "type":"83", "bootable":true}
+		if partition := self.block_device.partition_table.get(self.path):
+			return partition.get('bootable', False)
 
 		return False
 
 	@property
 	def partition_type(self) -> Optional[str]:
-		lsblk = json.loads(SysCommand(f"lsblk --json -o+PTTYPE {self.device_path}").decode('UTF-8'))
-
-		for device in lsblk['blockdevices']:
-			return device['pttype']
+		return self.inventory_info.get('pttype')
 
 	@property
 	def uuid(self) -> Optional[str]:
@@ -191,14 +184,15 @@ class Partition:
 		it doesn't seam to be able to detect md raid partitions.
 		For bind mounts all the subvolumes share the same uuid
 		"""
-		for i in range(storage['DISK_RETRY_ATTEMPTS']):
-			self.partprobe()
-
-			partuuid = self._safe_uuid
-			if partuuid:
-				return partuuid
+		def partuuid() -> Optional[str]:
+			try:
+				return self._safe_uuid
+			except DiskError:
+				# Not published by the kernel/udev yet
+				return None
 
-			time.sleep(storage['DISK_TIMEOUTS'])
+		if partuuid := wait_for_devices(partuuid, device_deadline()):
+			return partuuid
 
 		raise DiskError(f"Could not get PARTUUID for {self.path} using 'blkid -s PARTUUID -o value {self.path}'")
 
@@ -209,18 +203,23 @@ class Partition:
 		This function should only be used where uuid is not crucial.
 		For instance when you want to get a __repr__ of the class.
 		"""
-		self.partprobe()
+		if partuuid := self.inventory_info.get('partuuid'):
+			return partuuid
+
 		try:
-			return SysCommand(f'blkid -s PARTUUID -o value {self.device_path}').decode('UTF-8').strip()
+			# udev hasn't (yet) told lsblk about it, ask the partition table directly
+			return SysCommand(f'blkid -s PARTUUID -o value {self.device_path}', mode='pipe').decode('UTF-8').strip()
 		except SysCallError as error:
 			if self.block_device.info.get('TYPE') == 'iso9660':
 				# Parent device is a Optical Disk (.iso dd'ed onto a device for instance)
 				return None
 
-			raise DiskError(f"Could not get PARTUUID of partition {self}: {error}")
+			raise DiskError(f"Could not get PARTUUID of partition {self.path}: {error}")
 
 	@property
 	def encrypted(self) -> Union[bool, None]:
+		# Detecting the file system is what tells us if it's a LUKS container
+		self.filesystem
 		return self._encrypted
 
 	@encrypted.setter
@@ -233,7 +232,7 @@ class Partition:
 
 	@property
 	def real_device(self) -> str:
-		for blockdevice in json.loads(SysCommand('lsblk -J').decode('UTF-8'))['blockdevices']:
+		for blockdevice in json.loads(SysCommand('lsblk -J', mode='pipe').decode('UTF-8'))['blockdevices']:
 			if parent := self.find_parent_of(blockdevice, os.path.basename(self.device_path)):
 				return f"/dev/{parent}"
 		# 	raise DiskError(f'Could not find appropriate parent for encrypted partition {self}')
@@ -260,12 +259,28 @@ class Partition:
 			for result in get_subvolumes_from_findmnt(mountpoint):
 				yield result
 
-	def partprobe(self) -> bool:
-		if self.block_device and SysCommand(f'partprobe {self.block_device.device}').exit_code == 0:
-			time.sleep(1)
+	def partprobe(self, requested_by :str = 'Partition.partprobe()') -> bool:
+		if self.block_device is None:
+			return False
+
+		record_rescan(self.block_device.device, requested_by)
+		if SysCommand(f'partprobe {self.block_device.device}').exit_code == 0:
+			settle_devices(device_deadline())
 			return True
 		return False
 
+	def refresh(self, requested_by :str = 'Partition.refresh()') -> bool:
+		"""
+		Re-reads the partition table of the disk this partition is on (see :py:meth:`BlockDevice.refresh`)
+		and forgets the mount information. Reading properties never does this on its own.
+		"""
+		self._mount_information = None
+
+		if self.block_device is None:
+			return False
+
+		return self.block_device.refresh(requested_by)
+
 	def detect_inner_filesystem(self, password :str) -> Optional[str]:
 		log(f'Trying to detect inner filesystem format on {self} (This might take a while)', level=logging.INFO)
 		from ..luks import luks2
@@ -321,9 +336,7 @@ class Partition:
 		filesystem = get_mount_fs_type(filesystem)
 
 		# To avoid "unable to open /dev/x: No such file or directory"
-		start_wait = time.time()
-		while pathlib.Path(path).exists() is False and time.time() - start_wait < 10:
-			time.sleep(0.025)
+		wait_for_devices(lambda: pathlib.Path(path).exists(), device_deadline(10))
 
 		if log_formatting:
 			log(f'Formatting {path} -> {filesystem}', level=logging.INFO)
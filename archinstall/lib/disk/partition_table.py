@@ -0,0 +1,50 @@
+import json
+from typing import Any, Dict, Iterator, Optional
+
+from ..general import SysCommand
+
+
+class PartitionTable:
+	"""
+	The parsed partition table of a disk, as reported by ``sfdisk --json``.
+	Partitions are indexed by their device node, start and size are in sectors:
+
+	.. code-block:: json
+
+		{
+			"partitiontable": {
+				"label":"gpt", "id":"...", "device":"/dev/loop0", "unit":"sectors", "sectorsize":512,
+				"partitions": [
+					{"node":"/dev/loop0p1", "start":2048, "size":10483712, "type":"...", "uuid":"...", "bootable":true}
+				]
+			}
+		}
+	"""
+	def __init__(self, data :Dict[str, Any]) -> None:
+		table = data.get('partitiontable', {})
+
+		self.label :Optional[str] = table.get('label')
+		self.id :Optional[str] = table.get('id')
+		self.device :Optional[str] = table.get('device')
+		self.unit :Optional[str] = table.get('unit')
+		self.sector_size :int = table.get('sectorsize', 512)
+		self.partitions :Dict[str, Dict[str, Any]] = {partition['node']: partition for partition in table.get('partitions', [])}
+
+	def __contains__(self, node :str) -> bool:
+		return node in self.partitions
+
+	def __iter__(self) -> Iterator[Dict[str, Any]]:
+		return iter(self.partitions.values())
+
+	def __len__(self) -> int:
+		return len(self.partitions)
+
+	def __repr__(self) -> str:
+		return f"PartitionTable(device={self.device}, label={self.label}, partitions={list(self.partitions)})"
+
+	@classmethod
+	def read(cls, path :str) -> 'PartitionTable':
+		return cls(json.loads(SysCommand(f"sfdisk --json {path}", mode='pipe').decode('UTF-8')))
+
+	def get(self, node :str) -> Optional[Dict[str, Any]]:
+		return self.partitions.get(node)
@@ -0,0 +1,91 @@
+import re
+from typing import Any, Dict, Optional
+
+from ..replay import read_file
+
+UDEV_DATABASE = '/run/udev/data'
+
+# udev runs the blkid builtin on every block device and stores the result with ID_ prefixed names.
+# This maps them back to what `blkid -p -o export` calls them, so the two sources are interchangeable.
+UDEV_TO_BLKID = {
+	'ID_FS_TYPE': 'TYPE',
+	'ID_FS_UUID': 'UUID',
+	'ID_FS_UUID_SUB': 'UUID_SUB',
+	# ID_FS_LABEL has anything but plain ASCII replaced, the encoded one is the label as it is (see udev_decode())
+	'ID_FS_LABEL_ENC': 'LABEL',
+	'ID_FS_VERSION': 'VERSION',
+	'ID_FS_USAGE': 'USAGE',
+	'ID_PART_TABLE_TYPE': 'PTTYPE',
+	'ID_PART_TABLE_UUID': 'PTUUID',
+}
+
+
+def udev_decode(value :str) -> str:
+	"""
+	Decodes the ``\\xNN`` escapes (``My\\x20Disk``) udev uses in encoded values like ``ID_FS_LABEL_ENC``.
+	"""
+	if '\\x' not in value:
+		return value
+
+	# Valid UTF-8 is left as it is, the escapes are of bytes (of a multi byte character for instance)
+	decoded = re.sub(rb'\\x([0-9a-fA-F]{2})', lambda match: bytes([int(match.group(1), 16)]), value.encode('UTF-8'))
+	return decoded.decode('UTF-8', errors='replace')
+
+
+def udev_database_entry(dev_name :str) -> Optional[Dict[str, str]]:
+	"""
+	Returns the properties udev has stored for the block device ``dev_name`` (``sda1`` for instance)
+	in ``/run/udev/data/b<major>:<minor>``, or None if udev hasn't processed the device (or isn't running).
+	"""
+	try:
+		major_minor = read_file(f'/sys/class/block/{dev_name}/dev').strip()
+		data = read_file(f'{UDEV_DATABASE}/b{major_minor}')
+	except OSError:
+		return None
+
+	properties = {}
+	for line in data.split('\n'):
+		# Each line is a single character type, a colon and the value. E: lines are the device properties,
+		# the others are symlinks (S:), tags (G:, Q:), the initialization time (I:) and so on.
+		if line[:2] == 'E:' and '=' in line:
+			key, val = line[2:].split('=', 1)
+			properties[key] = val
+
+	return properties
+
+
+def udev_blkid_information(dev_name :str) -> Optional[Dict[str, Dict[str, Any]]]:
+	"""
+	Returns the same information as ``blkid -p -o export /dev/<dev_name>`` (see :py:func:`parse_blkid_export`),
+	read from the udev database instead of probing the device.
+	Returns None if udev doesn't have (complete) information about the device, in which case blkid has to be asked.
+	An empty dictionary means udev found nothing on the device, which is what makes blkid exit with code 2.
+	"""
+	if (properties := udev_database_entry(dev_name)) is None:
+		return None
+
+	if properties.get('DM_UDEV_DISABLE_OTHER_RULES_FLAG') == '1':
+		# Device mapper devices that aren't set up yet (or are suspended) don't get probed by udev
+		return None
+
+	information :Dict[str, Any] = {}
+	for key, val in properties.items():
+		if key in UDEV_TO_BLKID:
+			information[UDEV_TO_BLKID[key]] = udev_decode(val) if key.endswith('_ENC') else val
+		elif key == 'ID_PART_ENTRY_NAME':
+			# Encoded the same way as ID_FS_LABEL_ENC
+			information['PART_ENTRY_NAME'] = udev_decode(val)
+		elif key.startswith('ID_PART_ENTRY_'):
+			information[key[len('ID_'):]] = val
+
+	if not information:
+		return {}
+
+	device_path = f'/dev/{dev_name}'
+	return {
+		device_path: {
+			'path': device_path,
+			'PATH': device_path,
+			**information
+		}
+	}
@@ -48,4 +48,8 @@ class PackageError(BaseException):
 
 
 class TranslationError(BaseException):
-	pass
\ No newline at end of file
+	pass
+
+
+class ReplayError(BaseException):
+	pass
@@ -1,17 +1,22 @@
 from __future__ import annotations
+import asyncio
 import hashlib
 import json
 import logging
+import mmap
 import os
 import secrets
 import shlex
-import subprocess
+import signal
 import string
 import sys
+import tempfile
 import time
 import re
+import resource
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date
-from typing import Callable, Optional, Dict, Any, List, Union, Iterator, TYPE_CHECKING
+from typing import Callable, Optional, Dict, Any, List, Union, Iterator, Tuple, TYPE_CHECKING
 # https://stackoverflow.com/a/39757388/929999
 if TYPE_CHECKING:
 	from .installer import Installer
@@ -47,8 +52,11 @@ else:
 			except OSError:
 				return []
 
-from .exceptions import RequirementError, SysCallError
-from .output import log
+from .accounting import CommandRecord, record_command
+from .exceptions import ReplayError, RequirementError, SysCallError
+from .output import log, BufferedLogFile
+from .probe_cache import probe_cache
+from .replay import RecordedCommand, active_recorder, active_replay
 from .storage import storage
 
 def gen_uid(entropy_length :int = 256) -> str:
@@ -72,27 +80,71 @@ def multisplit(s :str, splitters :List[str]) -> str:
 		s = ns
 	return s
 
+
+# Resolved binaries, keyed by (name, $PATH). Only successful lookups are cached,
+# so a binary installed later on is still found. Use flush_binary_cache() to invalidate.
+_binary_cache :Dict[Tuple[str, str], str] = {}
+_binary_cache_statistics = {'hits': 0, 'misses': 0}
+
 def locate_binary(name :str) -> str:
-	for PATH in os.environ['PATH'].split(':'):
-		for root, folders, files in os.walk(PATH):
-			for file in files:
-				if file == name:
-					return os.path.join(root, file)
-			break # Don't recurse
+	PATHS = os.environ['PATH']
+
+	if (binary := _binary_cache.get((name, PATHS))):
+		_binary_cache_statistics['hits'] += 1
+		return binary
+
+	_binary_cache_statistics['misses'] += 1
+
+	for PATH in PATHS.split(':'):
+		if os.path.isfile(binary := os.path.join(PATH, name)):
+			_binary_cache[(name, PATHS)] = binary
+			return binary
 
 	raise RequirementError(f"Binary {name} does not exist.")
 
-def clear_vt100_escape_codes(data :Union[bytes, str]):
-	# https://stackoverflow.com/a/43627833/929999
-	if type(data) == bytes:
-		vt100_escape_regex = bytes(r'\x1B\[[?0-9;]*[a-zA-Z]', 'UTF-8')
-	else:
-		vt100_escape_regex = r'\x1B\[[?0-9;]*[a-zA-Z]'
+def flush_binary_cache() -> None:
+	"""
+	Forgets all binaries resolved by :py:func:`locate_binary`,
+	for instance after packages have been removed from the live medium.
+	"""
+	_binary_cache.clear()
+
+def binary_cache_statistics() -> Dict[str, int]:
+	"""
+	Returns how many :py:func:`locate_binary` lookups were served
+	from the cache (``hits``) and how many had to search ``$PATH`` (``misses``).
+	"""
+	return {**_binary_cache_statistics, 'cached': len(_binary_cache)}
+
+def pidfd_open(pid :int) -> Optional[int]:
+	"""
+	Returns a file descriptor that becomes readable the moment ``pid`` exits.
+	Returns None if the kernel (< 5.3) or Python doesn't support pidfd's,
+	in which case the caller has to fall back on ``waitpid(WNOHANG)``.
+	"""
+	if not hasattr(os, 'pidfd_open'):
+		return None
 
-	for match in re.findall(vt100_escape_regex, data, re.IGNORECASE):
-		data = data.replace(match, '' if type(data) == str else b'')
+	try:
+		return os.pidfd_open(pid)
+	except OSError:
+		return None
 
-	return data
+
+# https://stackoverflow.com/a/43627833/929999
+VT100_ESCAPE_REGEX = r'\x1B\[[?0-9;]*[a-zA-Z]'
+_vt100_escape_pattern = re.compile(VT100_ESCAPE_REGEX)
+_vt100_escape_pattern_bytes = re.compile(VT100_ESCAPE_REGEX.encode('UTF-8'))
+
+def clear_vt100_escape_codes(data :Union[bytes, bytearray, memoryview, str]) -> Union[bytes, str]:
+	"""
+	Removes all VT100 escape codes in a single pass.
+	Any bytes-like input (including a ``memoryview`` of an :ref:`OutputBuffer`) returns ``bytes``.
+	"""
+	if isinstance(data, str):
+		return _vt100_escape_pattern.sub('', data)
+
+	return _vt100_escape_pattern_bytes.sub(b'', data)
 
 def json_dumps(*args :str, **kwargs :str) -> str:
 	return json.dumps(*args, **{**kwargs, 'cls': JSON})
@@ -174,6 +226,214 @@ class UNSAFE_JSON(json.JSONEncoder, json.JSONDecoder):
 	def encode(self, obj :Any) -> Any:
 		return super(UNSAFE_JSON, self).encode(self._encode(obj))
 
+
+cmd_history_log = BufferedLogFile('cmd_history.txt')
+cmd_output_log = BufferedLogFile('cmd_output.txt')
+
+def flush_command_logs() -> None:
+	cmd_history_log.flush()
+	cmd_output_log.flush()
+
+class OutputBuffer:
+	"""
+	A growable output buffer used by :ref:`SysCommandWorker` to store the output of a command.
+	Appending is amortized O(1) and searching or slicing a window of it doesn't
+	copy anything but the window itself. It behaves like ``bytes`` for the
+	common operations (``len()``, ``in``, slicing, ``.find()``, ``.decode()``).
+
+	If ``memory_limit`` (in bytes) is given, only the last ``memory_limit`` bytes are kept
+	in memory. As soon as the output grows beyond that, all of it is streamed to an unlinked
+	file under ``spill_directory`` and any access to older output is served through ``mmap``.
+	Positions are always absolute, regardless of how much has been spilled to disk or :py:meth:`discard`:ed.
+	``bytes()`` and ``.decode()`` return all of the output by definition, the other operations only
+	ever copy what they return, so prefer those (``.lines()``, ``.find()``, slices) for large output.
+	"""
+	def __init__(self, memory_limit :Optional[int] = None, spill_directory :Optional[str] = None) -> None:
+		self._buffer = bytearray()
+		# The absolute position of self._buffer[0], anything before it only exists in the spill file.
+		self._offset = 0
+		# The absolute position of the first byte that's still around (in the spill file or in memory)
+		self._start = 0
+		self._memory_limit = memory_limit
+		self._spill_directory = spill_directory
+		self._spill_file :Optional[Any] = None
+		# A single read-only mapping of the spill file, only replaced once the file has grown past it
+		self._map :Optional[mmap.mmap] = None
+
+	def __len__(self) -> int:
+		return self._offset + len(self._buffer)
+
+	def __bytes__(self) -> bytes:
+		return self[:]
+
+	def __repr__(self) -> str:
+		return repr(self[:])
+
+	def __contains__(self, key :bytes) -> bool:
+		return self.find(key) != -1
+
+	def __getitem__(self, key :Union[int, slice]) -> Union[int, bytes]:
+		if type(key) is slice:
+			if key.step not in (None, 1):
+				return self[key.start:key.stop][::key.step]
+
+			start, end = self._bounds(key.start, key.stop)
+			if start >= self._offset:
+				with memoryview(self._buffer) as view:
+					return view[start - self._offset:end - self._offset].tobytes()
+
+			return self._mapped()[start - self._start:end - self._start]
+
+		if key < 0:
+			key += len(self)
+		if not self._start <= key < len(self):
+			raise IndexError('OutputBuffer index out of range')
+
+		if key >= self._offset:
+			return self._buffer[key - self._offset]
+
+		return self._mapped()[key - self._start]
+
+	@property
+	def spilled(self) -> bool:
+		return self._spill_file is not None
+
+	@property
+	def truncated(self) -> bool:
+		"""
+		True if the start of the output was thrown away with :py:meth:`discard`.
+		"""
+		return self._start > 0
+
+	def discard(self, end :int) -> None:
+		"""
+		Throws away the output before the absolute position ``end``, for consumers that have processed it
+		and don't want it to pile up in memory. Output that was spilled to disk is kept (it's not in memory anyway).
+		"""
+		if self._spill_file is not None or (count := min(end, len(self)) - self._offset) <= 0:
+			return
+
+		del self._buffer[:count]
+		self._offset += count
+		self._start = self._offset
+
+	def append(self, data :bytes) -> None:
+		if self._memory_limit is not None and self._spill_file is None and len(self._buffer) + len(data) > self._memory_limit:
+			self._open_spill_file()
+
+		if self._spill_file:
+			self._spill_file.write(data)
+
+		self._buffer += data
+
+		if self._spill_file and (overflow := len(self._buffer) - self._memory_limit) > 0:
+			# Deleting from the start of a bytearray is cheap, CPython only moves the start pointer.
+			del self._buffer[:overflow]
+			self._offset += overflow
+
+	def _open_spill_file(self) -> None:
+		try:
+			os.makedirs(self._spill_directory or storage['LOG_PATH'], exist_ok=True)
+			self._spill_file = tempfile.TemporaryFile(prefix='cmd_output.', dir=self._spill_directory or storage['LOG_PATH'])
+		except OSError as error:
+			log(f"Could not create a spill file for command output, keeping it in memory instead: {error}", level=logging.DEBUG)
+			self._memory_limit = None
+			return
+
+		self._spill_file.write(self._buffer)
+
+	def _mapped(self) -> mmap.mmap:
+		# The spill file starts at self._start, which is where the mapping's positions are relative to
+		if self._map is None or len(self._map) < len(self) - self._start:
+			self._spill_file.flush()
+			# The previous mapping isn't closed here, views handed out by view() may still reference it.
+			# It's unmapped as soon as the last of them is released.
+			self._map = mmap.mmap(self._spill_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+		return self._map
+
+	def close(self) -> None:
+		"""
+		Closes (and thereby deletes) the spill file, after which only the output kept in memory is accessible.
+		"""
+		if self._map is not None:
+			try:
+				self._map.close()
+			except BufferError:
+				# Still referenced by a view, it goes away together with that
+				pass
+			self._map = None
+
+		if self._spill_file is not None:
+			self._spill_file.close()
+			self._spill_file = None
+			self._start = self._offset
+
+	def __del__(self) -> None:
+		self.close()
+
+	def _bounds(self, start :Optional[int], end :Optional[int]) -> Tuple[int, int]:
+		start, end, _ = slice(start, end).indices(len(self))
+		# Anything before self._start has been discarded
+		start = max(start, self._start)
+		return start, max(start, end)
+
+	def view(self, start :int = 0, end :Optional[int] = None) -> memoryview:
+		"""
+		Returns a zero-copy window of the buffer.
+		The view has to be released before any more output is appended to the buffer.
+		"""
+		start, end = self._bounds(start, end)
+		if start >= self._offset:
+			return memoryview(self._buffer)[start - self._offset:end - self._offset]
+
+		return memoryview(self._mapped())[start - self._start:end - self._start]
+
+	def find(self, key :bytes, start :int = 0, end :Optional[int] = None) -> int:
+		start, end = self._bounds(start, end)
+		if start >= self._offset:
+			if (index := self._buffer.find(key, start - self._offset, end - self._offset)) == -1:
+				return -1
+			return index + self._offset
+
+		if (index := self._mapped().find(key, start - self._start, end - self._start)) == -1:
+			return -1
+		return index + self._start
+
+	def rfind(self, key :bytes, start :int = 0, end :Optional[int] = None) -> int:
+		start, end = self._bounds(start, end)
+		if start >= self._offset:
+			if (index := self._buffer.rfind(key, start - self._offset, end - self._offset)) == -1:
+				return -1
+			return index + self._offset
+
+		if (index := self._mapped().rfind(key, start - self._start, end - self._start)) == -1:
+			return -1
+		return index + self._start
+
+	def lines(self, start :int = 0, end :Optional[int] = None) -> Iterator[bytes]:
+		"""
+		Iterates the lines (without the line ending) between ``start`` and ``end``.
+		Only the individual lines are copied out of the buffer.
+		"""
+		start, end = self._bounds(start, end)
+
+		while start < end:
+			if (line_end := self.find(b'\n', start, end)) == -1:
+				line_end = end
+
+			yield self[start:line_end]
+			start = line_end + 1
+
+	def decode(self, encoding :str = 'UTF-8', errors :str = 'strict') -> str:
+		if self._spill_file is None:
+			return self._buffer.decode(encoding, errors)
+
+		# Decoded straight from the mapping, without copying the spilled output into a bytes object first
+		with memoryview(self._mapped()) as view:
+			return str(view, encoding, errors)
+
+
 class SysCommandWorker:
 	def __init__(self,
 		cmd :Union[str, List[str]],
@@ -182,8 +442,24 @@ class SysCommandWorker:
 		environment_vars :Optional[Dict[str, Any]] = None,
 		logfile :Optional[None] = None,
 		working_directory :Optional[str] = './',
-		remove_vt100_escape_codes_from_lines :bool = True):
-
+		remove_vt100_escape_codes_from_lines :bool = True,
+		output_memory_limit :Optional[int] = None,
+		mode :Optional[str] = None,
+		stdin :Optional[bytes] = None):
+		"""
+		:param output_memory_limit: How many KiB of output to keep in memory, anything older
+			is spilled to a file under ``storage['LOG_PATH']``. Defaults to ``storage['CMD_OUTPUT_MEMORY_LIMIT']``.
+		:type output_memory_limit: int, optional
+
+		:param mode: ``'pty'`` runs the command in a pseudo terminal, which interactive commands need.
+			``'pipe'`` runs it with plain pipes, no terminal line discipline and stderr kept apart from stdout
+			in ``.stderr``, which is cheaper and cleaner for non-interactive commands. Defaults to ``'pty'``,
+			callers asking for ``'pipe'`` have to look for error messages in ``.stderr`` (:ref:`SysCallError` includes it).
+		:type mode: str, optional
+
+		:param stdin: Data to give the command on its standard input, for instance an ``sfdisk`` script. Requires ``mode='pipe'``.
+		:type stdin: bytes, optional
+		"""
 		if not callbacks:
 			callbacks = {}
 		if not environment_vars:
@@ -193,13 +469,23 @@ class SysCommandWorker:
 			cmd = shlex.split(cmd)
 
 		cmd = list(cmd) # This is to please mypy
-		if cmd[0][0] != '/' and cmd[0][:2] != './':
+		if cmd[0][0] != '/' and cmd[0][:2] != './' and not active_replay():
 			# "which" doesn't work as it's a builtin to bash.
 			# It used to work, but for whatever reason it doesn't anymore.
 			# We there for fall back on manual lookup in os.PATH
 			cmd[0] = locate_binary(cmd[0])
 
+		if mode is None:
+			mode = 'pty'
+		elif mode not in ('pty', 'pipe'):
+			raise ValueError(f"SysCommandWorker() mode has to be either 'pty' or 'pipe', not {mode}")
+
+		if stdin is not None and mode != 'pipe':
+			raise ValueError(f"SysCommandWorker() can only give {cmd} stdin in mode='pipe'")
+
 		self.cmd = cmd
+		self.mode = mode
+		self.stdin = stdin
 		self.callbacks = callbacks
 		self.peak_output = peak_output
 		# define the standard locale for command outputs. For now the C ascii one. Can be overriden
@@ -207,15 +493,34 @@ class SysCommandWorker:
 		self.logfile = logfile
 		self.working_directory = working_directory
 
+		if output_memory_limit is None:
+			output_memory_limit = storage.get('CMD_OUTPUT_MEMORY_LIMIT', None)
+
 		self.exit_code :Optional[int] = None
-		self._trace_log = b''
+		self._trace_log = OutputBuffer(memory_limit=output_memory_limit * 1024 if output_memory_limit else None)
 		self._trace_log_pos = 0
+		self._stderr_log = OutputBuffer()
 		self.poll_object = epoll()
 		self.child_fd :Optional[int] = None
+		# Only used in pipe mode, where stderr is read separately from stdout (self.child_fd)
+		self.stderr_fd :Optional[int] = None
+		self._output_fds :List[int] = []
+		self.pid_fd :Optional[int] = None
 		self.started :Optional[float] = None
 		self.ended :Optional[float] = None
+		self.rusage :Optional[resource.struct_rusage] = None
+		self._probe_stamp :Optional[Tuple[Any, ...]] = None
+		# Set when the result comes from a fixture instead of actually executing the command, see CommandReplay()
+		self._replayed :Optional[RecordedCommand] = None
+		self._replay_deadline = 0.0
 		self.remove_vt100_escape_codes_from_lines :bool = remove_vt100_escape_codes_from_lines
 
+	def __del__(self) -> None:
+		# The spill files of the output go together with the worker
+		for output in (getattr(self, '_trace_log', None), getattr(self, '_stderr_log', None)):
+			if output is not None:
+				output.close()
+
 	def __contains__(self, key: bytes) -> bool:
 		"""
 		Contains will also move the current buffert position forward.
@@ -223,25 +528,101 @@ class SysCommandWorker:
 		"""
 		assert type(key) == bytes
 
-		if (contains := key in self._trace_log[self._trace_log_pos:]):
-			self._trace_log_pos += self._trace_log[self._trace_log_pos:].find(key) + len(key)
+		if (index := self._trace_log.find(key, self._trace_log_pos)) == -1:
+			return False
 
-		return contains
+		self._trace_log_pos = index + len(key)
+		return True
 
 	def __iter__(self, *args :str, **kwargs :Dict[str, Any]) -> Iterator[bytes]:
-		for line in self._trace_log[self._trace_log_pos:self._trace_log.rfind(b'\n')].split(b'\n'):
+		if (last_line_ending := self._trace_log.rfind(b'\n', self._trace_log_pos)) == -1:
+			return
+
+		for line in self._trace_log.lines(self._trace_log_pos, last_line_ending):
 			if line:
 				if self.remove_vt100_escape_codes_from_lines:
 					line = clear_vt100_escape_codes(line)
 
 				yield line + b'\n'
 
-		self._trace_log_pos = self._trace_log.rfind(b'\n')
+		self._trace_log_pos = last_line_ending
 
 	def __repr__(self) -> str:
 		self.make_sure_we_are_executing()
 		return str(self._trace_log)
 
+	def stream(self, encoding :str = 'UTF-8') -> Iterator[str]:
+		"""
+		Yields each line of output (decoded and without the line ending) as soon as it's complete,
+		while the command is still running. Output is only read off the pty when the next line is
+		asked for, so a slow consumer makes the command wait on a full pty instead of piling up output.
+
+		Lines that were yielded are thrown away (see :py:meth:`OutputBuffer.discard`) rather than kept around,
+		unless a :ref:`CommandRecorder` needs all of it. Once the command has exited, a last line without
+		a line ending is yielded as well.
+
+		Raises :ref:`SysCallError` once all output is consumed if the command exited abnormally.
+		Stopping the iteration early terminates the command.
+		"""
+		self.make_sure_we_are_executing()
+
+		try:
+			while True:
+				for line in self:
+					yield line.decode(encoding).rstrip('\r\n')
+
+				if self.ended is not None:
+					break
+
+				if not active_recorder():
+					# Keep the line ending of the last line, __iter__() looks for it
+					self._trace_log.discard(self._trace_log_pos)
+
+				self.poll(timeout=None)
+
+			if (last_line := self._trace_log[self._trace_log_pos:].lstrip(b'\n')):
+				if self.remove_vt100_escape_codes_from_lines:
+					last_line = clear_vt100_escape_codes(last_line)
+
+				yield last_line.decode(encoding).rstrip('\r\n')
+				self._trace_log_pos = len(self._trace_log)
+		finally:
+			if self.ended is None:
+				self.terminate()
+
+		self.__exit__()
+
+	def terminate(self, timeout :float = 5) -> None:
+		"""
+		Sends SIGTERM to a still running command and waits for it to exit.
+		If it hasn't after ``timeout`` seconds, it's killed with SIGKILL.
+		"""
+		if self._replayed is not None and self.ended is None:
+			# Nothing to signal, the command is over once its recorded latency has passed
+			self._finish_replay()
+		elif self.started and self.ended is None:
+			try:
+				os.kill(self.pid, signal.SIGTERM)
+			except ProcessLookupError:
+				pass
+
+			deadline = time.monotonic() + timeout
+			while self.ended is None and time.monotonic() < deadline:
+				self._reap(blocking=False)
+				if self.ended is None:
+					time.sleep(0.01)
+
+			if self.ended is None:
+				log(f"{self.cmd} didn't exit within {timeout} seconds of SIGTERM, killing it", level=logging.DEBUG)
+				try:
+					os.kill(self.pid, signal.SIGKILL)
+				except ProcessLookupError:
+					pass
+
+				self._reap()
+
+		self._close_output_fds()
+
 	def __enter__(self) -> 'SysCommandWorker':
 		return self
 
@@ -249,11 +630,7 @@ class SysCommandWorker:
 		# b''.join(sys_command('sync')) # No need to, since the underlying fs() object will call sync.
 		# TODO: https://stackoverflow.com/questions/28157929/how-to-safely-handle-an-exception-inside-a-context-manager
 
-		if self.child_fd:
-			try:
-				os.close(self.child_fd)
-			except:
-				pass
+		self._close_output_fds()
 
 		if self.peak_output:
 			# To make sure any peaked output didn't leave us hanging
@@ -264,8 +641,18 @@ class SysCommandWorker:
 		if len(args) >= 2 and args[1]:
 			log(args[1], level=logging.DEBUG, fg='red')
 
-		if self.exit_code != 0:
-			raise SysCallError(f"{self.cmd} exited with abnormal exit code [{self.exit_code}]: {self._trace_log[-500:]}", self.exit_code)
+		if self.started and self.exit_code != 0:
+			flush_command_logs()
+			# In pipe mode the reason for the failure is usually found on stderr
+			error_output = self._stderr_log[-500:] if len(self._stderr_log) else self._trace_log[-500:]
+			raise SysCallError(f"{self.cmd} exited with abnormal exit code [{self.exit_code}]: {error_output}", self.exit_code)
+
+	@property
+	def stderr(self) -> bytes:
+		"""
+		The output the command wrote to stderr, only separated from the regular output in pipe mode.
+		"""
+		return bytes(self._stderr_log)
 
 	def is_alive(self) -> bool:
 		self.poll()
@@ -278,6 +665,9 @@ class SysCommandWorker:
 	def write(self, data: bytes, line_ending :bool = True) -> int:
 		assert type(data) == bytes  # TODO: Maybe we can support str as well and encode it
 
+		if self.mode == 'pipe':
+			raise ValueError(f"{self.cmd} runs in pipe mode, which doesn't take any input. Use mode='pty' for interactive commands.")
+
 		self.make_sure_we_are_executing()
 
 		if self.child_fd:
@@ -307,76 +697,257 @@ class SysCommandWorker:
 				except UnicodeDecodeError:
 					return False
 
-			with open(f"{storage['LOG_PATH']}/cmd_output.txt", "a") as peak_output_log:
-				peak_output_log.write(output)
+			cmd_output_log.write(output)
 
 			sys.stdout.write(str(output))
 			sys.stdout.flush()
 
 		return True
 
-	def poll(self) -> None:
+	def poll(self, timeout :Optional[float] = 0.1) -> None:
+		"""
+		Waits up to ``timeout`` seconds (``None`` meaning until something happens)
+		for either output from the child or the child exiting.
+		The child exiting is an event of its own through a pidfd registered in the
+		same epoll set as the pty, so there's no need to wait for the timeout to
+		detect that a process has finished.
+		"""
 		self.make_sure_we_are_executing()
 
-		if self.child_fd:
-			got_output = False
-			for fileno, event in self.poll_object.poll(0.1):
-				try:
-					output = os.read(self.child_fd, 8192)
-					got_output = True
-					self.peak(output)
-					self._trace_log += output
-				except OSError:
-					self.ended = time.time()
+		if self._replayed is not None:
+			if self.ended is None:
+				if timeout is not None and self._replay_deadline - time.time() > timeout:
+					time.sleep(timeout)
+					return
+
+				time.sleep(max(0.0, self._replay_deadline - time.time()))
+				self._finish_replay()
+			return
+
+		if self.child_fd and self.ended is None:
+			if self.pid_fd is None and (timeout is None or timeout > 0.1):
+				# Without a pidfd there's no event telling us the child is gone,
+				# so we can't block for longer than a short moment between waitpid() checks.
+				timeout = 0.1
+
+			for fileno, event in self.poll_object.poll(-1 if timeout is None else timeout):
+				if fileno == self.pid_fd:
+					# The child has exited, grab anything still left in the pty/pipes before reaping it.
+					self._drain_output()
+					self._reap()
 					break
 
-			if self.ended or (got_output is False and pid_exists(self.pid) is False):
-				self.ended = time.time()
+				if not self._read_output(fileno) and not self._output_fds:
+					# EIO on the pty (or EOF on all pipes) means the child closed it's end, which it does when it exits.
+					self._drain_output()
+					self._reap()
+					break
+
+			if self.ended is None and self.pid_fd is None:
+				self._reap(blocking=False)
+
+	def _read_output(self, fileno :int) -> bool:
+		if fileno not in self._output_fds:
+			return False
+
+		try:
+			output = os.read(fileno, 8192)
+		except OSError:
+			output = b''
+
+		if not output:
+			# The pty raises EIO and pipes return EOF once the child has closed them
+			self._output_fds.remove(fileno)
+			self.poll_object.unregister(fileno)
+			return False
+
+		if fileno == self.stderr_fd:
+			self._stderr_log.append(output)
+		else:
+			self.peak(output)
+			self._trace_log.append(output)
+
+		return True
+
+	def _drain_output(self) -> None:
+		while (readable := [fileno for fileno, event in self.poll_object.poll(0) if fileno in self._output_fds]):
+			for fileno in readable:
+				self._read_output(fileno)
+
+	def _reap(self, blocking :bool = True) -> None:
+		try:
+			pid, status, self.rusage = os.wait4(self.pid, 0 if blocking else os.WNOHANG)
+		except ChildProcessError:
+			pid, status = self.pid, 256
+
+		if pid == 0:
+			# Still running (only happens for non-blocking checks)
+			return
+
+		# Whatever the child wrote before exiting might still be waiting to be read
+		self._drain_output()
+
+		self.ended = time.time()
+		self.exit_code = status
+		self._close_pid_fd()
+		self._finished()
+
+	def _finish_replay(self) -> None:
+		self.peak(self._replayed.output)
+		self._trace_log.append(self._replayed.output)
+		self._stderr_log.append(self._replayed.stderr)
+		self.ended = time.time()
+		self.exit_code = self._replayed.exit_code
+		self._finished()
+
+	def _finished(self) -> None:
+		if self._trace_log.spilled or self._trace_log.truncated:
+			# Too much output to be worth keeping around in the probe cache, or not all of it is left
+			self._probe_stamp = None
+
+		probe_cache.command_finished(self.cmd, self.environment_vars, self._probe_stamp, self.exit_code, self._trace_log, self._stderr_log)
+
+		if self._replayed is None and (recorder := active_recorder()):
+			recorder.record(RecordedCommand(
+				cmd=self.cmd,
+				environment=self.environment_vars,
+				exit_code=self.exit_code,
+				output=bytes(self._trace_log),
+				stderr=bytes(self._stderr_log),
+				wall_time=self.ended - self.started
+			))
+
+		record_command(CommandRecord(
+			cmd=self.cmd,
+			started=self.started,
+			ended=self.ended,
+			exit_code=self.exit_code,
+			output_bytes=len(self._trace_log),
+			user_time=self.rusage.ru_utime if self.rusage else 0.0,
+			system_time=self.rusage.ru_stime if self.rusage else 0.0,
+			max_rss=self.rusage.ru_maxrss if self.rusage else 0
+		))
+
+	def _close_output_fds(self) -> None:
+		for fileno in (self.child_fd, self.stderr_fd):
+			if fileno:
 				try:
-					self.exit_code = os.waitpid(self.pid, 0)[1]
-				except ChildProcessError:
-					try:
-						self.exit_code = os.waitpid(self.child_fd, 0)[1]
-					except ChildProcessError:
-						self.exit_code = 1
+					os.close(fileno)
+				except OSError:
+					pass
+
+		self.child_fd = None
+		self.stderr_fd = None
+		self._output_fds = []
+		self._close_pid_fd()
+
+	def _close_pid_fd(self) -> None:
+		if self.pid_fd is not None:
+			try:
+				self.poll_object.unregister(self.pid_fd)
+			except (OSError, ValueError):
+				pass
+
+			os.close(self.pid_fd)
+			self.pid_fd = None
 
 	def execute(self) -> bool:
 		import pty
 
-		if (old_dir := os.getcwd()) != self.working_directory:
-			os.chdir(str(self.working_directory))
+		if (cached := probe_cache.fetch(self.cmd, self.environment_vars)) is not None:
+			# Nothing has touched the devices this probe looks at since it last ran
+			self.started = self.ended = time.time()
+			self.exit_code = 0
+			self.peak(cached.output)
+			self._trace_log.append(cached.output)
+			self._stderr_log.append(cached.stderr)
+			return True
+
+		self._probe_stamp = probe_cache.command_started(self.cmd)
 
 		# Note: If for any reason, we get a Python exception between here
 		#   and until os.close(), the traceback will get locked inside
 		#   stdout of the child_fd object. `os.read(self.child_fd, 8192)` is the
 		#   only way to get the traceback without loosing it.
 
-		self.pid, self.child_fd = pty.fork()
-		os.chdir(old_dir)
+		# The history is written by the parent, through a long lived buffered handle,
+		# rather than having every forked child open and close the history file.
+		cmd_history_log.write(f"{' '.join(self.cmd)}\n")
 
-		# https://stackoverflow.com/questions/4022600/python-pty-fork-how-does-it-work
-		if not self.pid:
-			try:
-				try:
-					with open(f"{storage['LOG_PATH']}/cmd_history.txt", "a") as cmd_log:
-						cmd_log.write(f"{' '.join(self.cmd)}\n")
-				except PermissionError:
-					pass
+		if (replay := active_replay()) is not None:
+			self._replayed, latency = replay.fetch(self.cmd, self.environment_vars)
+			self.started = time.time()
+			self._replay_deadline = self.started + latency
+			if latency <= 0:
+				self._finish_replay()
+			return True
 
-				os.execve(self.cmd[0], list(self.cmd), {**os.environ, **self.environment_vars})
-				if storage['arguments'].get('debug'):
-					log(f"Executing: {self.cmd}", level=logging.DEBUG)
+		# Everything the child needs is prepared up front: other threads may hold locks (logging, imports, allocators)
+		# at the time of the fork, so the child must not do more than async-signal-safe calls before the exec
+		argv = list(self.cmd)
+		environment = {**os.environ, **self.environment_vars}
+		working_directory = str(self.working_directory) if self.working_directory else None
+		missing_binary = f"{self.cmd[0]} does not exist.\n".encode('UTF-8')
 
-			except FileNotFoundError:
-				log(f"{self.cmd[0]} does not exist.", level=logging.ERROR, fg="red")
-				self.exit_code = 1
-				return False
+		if self.mode == 'pipe':
+			stdout_read, stdout_write = os.pipe()
+			stderr_read, stderr_write = os.pipe()
+
+			stdin_file = None
+			if self.stdin is not None:
+				# A file rather than a pipe, so the child can't block us by not reading all of it
+				stdin_file = tempfile.TemporaryFile()
+				stdin_file.write(self.stdin)
+				stdin_file.seek(0)
+
+			stdin_fd = stdin_file.fileno() if stdin_file else os.open(os.devnull, os.O_RDONLY)
+
+			if not (pid := os.fork()):
+				# os.pipe() descriptors are non-inheritable, so only the dup2():ed copies survive the exec
+				try:
+					os.dup2(stdin_fd, 0)
+					os.dup2(stdout_write, 1)
+					os.dup2(stderr_write, 2)
+				finally:
+					self._exec_child(argv, environment, working_directory, missing_binary)
+
+			os.close(stdout_write)
+			os.close(stderr_write)
+			if stdin_file:
+				stdin_file.close()
+			else:
+				os.close(stdin_fd)
+			self.pid, self.child_fd, self.stderr_fd = pid, stdout_read, stderr_read
+		else:
+			# https://stackoverflow.com/questions/4022600/python-pty-fork-how-does-it-work
+			self.pid, self.child_fd = pty.fork()
+			if not self.pid:
+				self._exec_child(argv, environment, working_directory, missing_binary)
 
 		self.started = time.time()
-		self.poll_object.register(self.child_fd, EPOLLIN | EPOLLHUP)
+		self._output_fds = [fileno for fileno in (self.child_fd, self.stderr_fd) if fileno is not None]
+		for fileno in self._output_fds:
+			self.poll_object.register(fileno, EPOLLIN | EPOLLHUP)
+
+		if (pid_fd := pidfd_open(self.pid)) is not None:
+			self.pid_fd = pid_fd
+			self.poll_object.register(self.pid_fd, EPOLLIN)
 
 		return True
 
+	@staticmethod
+	def _exec_child(argv :List[str], environment :Dict[str, str], working_directory :Optional[str], missing_binary :bytes) -> None:
+		# Runs in the forked child, which must never return into the parent's code (or flush its inherited log buffers)
+		try:
+			if working_directory:
+				os.chdir(working_directory)
+			os.execve(argv[0], argv, environment)
+		except FileNotFoundError:
+			os.write(2, missing_binary)
+		finally:
+			# whatever went wrong (EACCES, ENOEXEC, a KeyboardInterrupt...)
+			os._exit(127)
+
 	def decode(self, encoding :str = 'UTF-8') -> str:
 		return self._trace_log.decode(encoding)
 
@@ -389,7 +960,10 @@ class SysCommand:
 		peak_output :Optional[bool] = False,
 		environment_vars :Optional[Dict[str, Any]] = None,
 		working_directory :Optional[str] = './',
-		remove_vt100_escape_codes_from_lines :bool = True):
+		remove_vt100_escape_codes_from_lines :bool = True,
+		output_memory_limit :Optional[int] = None,
+		mode :Optional[str] = None,
+		stdin :Optional[bytes] = None):
 
 		_callbacks = {}
 		if callbacks:
@@ -404,6 +978,9 @@ class SysCommand:
 		self.environment_vars = environment_vars
 		self.working_directory = working_directory
 		self.remove_vt100_escape_codes_from_lines = remove_vt100_escape_codes_from_lines
+		self.output_memory_limit = output_memory_limit
+		self.mode = mode
+		self.stdin = stdin
 
 		self.session :Optional[SysCommandWorker] = None
 		self.create_session()
@@ -457,12 +1034,21 @@ class SysCommand:
 		if self.session:
 			return self.session
 
-		with SysCommandWorker(self.cmd, callbacks=self._callbacks, peak_output=self.peak_output, environment_vars=self.environment_vars, remove_vt100_escape_codes_from_lines=self.remove_vt100_escape_codes_from_lines) as session:
+		with SysCommandWorker(
+			self.cmd,
+			callbacks=self._callbacks,
+			peak_output=self.peak_output,
+			environment_vars=self.environment_vars,
+			remove_vt100_escape_codes_from_lines=self.remove_vt100_escape_codes_from_lines,
+			output_memory_limit=self.output_memory_limit,
+			mode=self.mode,
+			stdin=self.stdin
+		) as session:
 			if not self.session:
 				self.session = session
 
 			while self.session.ended is None:
-				self.session.poll()
+				self.session.poll(timeout=None)
 
 		if self.peak_output:
 			sys.stdout.write('\n')
@@ -482,13 +1068,181 @@ class SysCommand:
 		else:
 			return None
 
+	@property
+	def stderr(self) -> Optional[bytes]:
+		if self.session:
+			return self.session.stderr
+		return None
+
 	@property
 	def trace_log(self) -> Optional[bytes]:
 		if self.session:
-			return self.session._trace_log
+			return bytes(self.session._trace_log)
 		return None
 
 
+class AsyncSysCommand(SysCommand):
+	"""
+	An awaitable :ref:`SysCommand` for running independent commands concurrently
+	from a single thread, for instance:
+
+	.. code-block:: python
+
+		lsblk, blkid = await asyncio.gather(AsyncSysCommand('lsblk --json'), AsyncSysCommand('blkid -o export'))
+
+	The command is started once awaited. It shares the pty/exec semantics, ``storage['CMD_LOCALE']``
+	handling and output accessors with :ref:`SysCommand` and raises :ref:`SysCallError` on a non-zero exit code.
+	"""
+	# Why the command couldn't be run at all when it was part of run_many(), a missing binary for instance
+	error :Optional[BaseException] = None
+
+	def __await__(self) -> Iterator[Any]:
+		return self.run().__await__()
+
+	def create_session(self) -> bool:
+		# The session is started by awaiting the instance instead of on creation.
+		return self.session is not None
+
+	async def run(self) -> 'AsyncSysCommand':
+		if self.session:
+			return self
+
+		self.session = SysCommandWorker(
+			self.cmd,
+			callbacks=self._callbacks,
+			peak_output=self.peak_output,
+			environment_vars=self.environment_vars,
+			working_directory=self.working_directory,
+			remove_vt100_escape_codes_from_lines=self.remove_vt100_escape_codes_from_lines,
+			output_memory_limit=self.output_memory_limit,
+			mode=self.mode,
+			stdin=self.stdin
+		)
+		self.session.make_sure_we_are_executing()
+
+		try:
+			await _wait_for_worker(self.session)
+		except asyncio.CancelledError:
+			self.session.terminate()
+			raise
+
+		# Closes the pty and raises SysCallError the same way SysCommand does
+		self.session.__exit__()
+
+		if self.peak_output:
+			sys.stdout.write('\n')
+			sys.stdout.flush()
+
+		return self
+
+
+async def _wait_for_worker(worker :SysCommandWorker) -> None:
+	"""
+	Waits for a started :ref:`SysCommandWorker` to finish without blocking the event loop,
+	by letting the loop watch the pty and the pidfd of the worker instead of polling them.
+	"""
+	if worker.ended is not None:
+		# Served from the probe cache
+		return
+
+	if worker._replayed is not None:
+		await asyncio.sleep(max(0.0, worker._replay_deadline - time.time()))
+		worker.poll(timeout=None)
+		return
+
+	loop = asyncio.get_running_loop()
+	finished = loop.create_future()
+	watched_fds = [fd for fd in (worker.child_fd, worker.stderr_fd, worker.pid_fd) if fd is not None]
+	fallback_timer = None
+
+	def on_event() -> None:
+		nonlocal fallback_timer
+
+		worker.poll(timeout=0)
+
+		for fd in [fd for fd in watched_fds if fd != worker.pid_fd and fd not in worker._output_fds]:
+			# A pipe at EOF stays readable, stop watching it so we don't spin until the child is reaped.
+			loop.remove_reader(fd)
+			watched_fds.remove(fd)
+
+		if worker.ended is not None:
+			# poll() has closed the pidfd by now, the selector tolerates unregistering closed fds.
+			_remove_readers()
+			if not finished.done():
+				finished.set_result(True)
+		elif worker.pid_fd is None:
+			# No pidfd means no event for the child exiting, so we'll have to check on it now and then.
+			# Output events get here too, so only one timer may be pending at a time.
+			if fallback_timer is not None:
+				fallback_timer.cancel()
+			fallback_timer = loop.call_later(0.1, on_event)
+
+	def _remove_readers() -> None:
+		while watched_fds:
+			loop.remove_reader(watched_fds.pop())
+
+	for fd in watched_fds:
+		loop.add_reader(fd, on_event)
+
+	if worker.pid_fd is None:
+		fallback_timer = loop.call_later(0.1, on_event)
+
+	try:
+		await finished
+	finally:
+		_remove_readers()
+		if fallback_timer:
+			fallback_timer.cancel()
+
+
+def run_many(commands :List[Union[str, List[str]]], max_workers :Optional[int] = None, **kwargs :Any) -> List[AsyncSysCommand]:
+	"""
+	Runs a batch of independent commands with at most ``max_workers`` (defaults to the CPU count)
+	running at the same time, and returns them in the same order as they were given.
+
+	Unlike :ref:`SysCommand`, a non-zero exit code does not raise :ref:`SysCallError`,
+	instead each result carries its own ``.exit_code`` next to the output.
+	A command that couldn't be run at all (:ref:`RequirementError` or :ref:`ReplayError`) doesn't stop the others either,
+	it has no exit code and the exception in ``.error`` instead.
+	Any additional keyword arguments are passed on to each :ref:`AsyncSysCommand`.
+
+	This starts its own event loop, from within asyncio code ``await`` :py:func:`run_many_async` instead.
+	Called from a running event loop anyway, the batch runs on a loop of its own in a helper thread,
+	blocking the caller like any other synchronous call would.
+	"""
+	try:
+		asyncio.get_running_loop()
+	except RuntimeError:
+		return asyncio.run(run_many_async(commands, max_workers, **kwargs))
+
+	# asyncio.run() refuses to run inside a running loop, so the batch gets a thread (and loop) of its own
+	with ThreadPoolExecutor(max_workers=1, thread_name_prefix='run_many') as executor:
+		return executor.submit(asyncio.run, run_many_async(commands, max_workers, **kwargs)).result()
+
+
+async def run_many_async(commands :List[Union[str, List[str]]], max_workers :Optional[int] = None, **kwargs :Any) -> List[AsyncSysCommand]:
+	"""
+	The awaitable version of :py:func:`run_many`, for use from within asyncio code.
+	"""
+	if max_workers is None:
+		max_workers = os.cpu_count() or 1
+
+	workers = asyncio.Semaphore(max_workers)
+
+	async def run_one(cmd :Union[str, List[str]]) -> AsyncSysCommand:
+		command = AsyncSysCommand(cmd, **kwargs)
+		async with workers:
+			try:
+				await command
+			except SysCallError:
+				pass
+			except (RequirementError, ReplayError) as error:
+				command.error = error
+		return command
+
+	return await asyncio.gather(*[run_one(cmd) for cmd in commands])
+
+
 def prerequisite_check() -> bool:
 	"""
 	This function is used as a safety check before
@@ -506,9 +1260,14 @@ def reboot():
 
 def pid_exists(pid: int) -> bool:
 	try:
-		return any(subprocess.check_output(['/usr/bin/ps', '--no-headers', '-o', 'pid', '-p', str(pid)]).strip())
-	except subprocess.CalledProcessError:
+		os.kill(pid, 0)
+	except ProcessLookupError:
 		return False
+	except PermissionError:
+		# The process exists, we're just not allowed to signal it
+		return True
+
+	return True
 
 
 def run_custom_user_commands(commands :List[str], installation :Installer) -> None:
@@ -1,4 +1,5 @@
 import time
+import functools
 import logging
 import os
 import re
@@ -10,11 +11,14 @@ import glob
 from types import ModuleType
 from typing import Union, Dict, Any, List, Optional, Iterator, Mapping, TYPE_CHECKING
 from .disk import get_partitions_in_use, Partition
-from .general import SysCommand, generate_password
+from .accounting import command_statistics
+from .general import SysCommand, generate_password, binary_cache_statistics, flush_command_logs
 from .hardware import has_uefi, is_vm, cpu_vendor
 from .locale_helpers import verify_keyboard_layout, verify_x11_keyboard_layout
-from .disk.helpers import get_mount_info
+from .disk.helpers import get_mount_info, run_per_device
 from .mirrors import use_mirrors
+from .probe_cache import probe_cache_statistics
+from .disk.blockdevice import rescan_statistics
 from .plugins import plugins
 from .storage import storage
 # from .user_interaction import *
@@ -145,6 +149,7 @@ class Installer:
 		if len(args) >= 2 and args[1]:
 			self.log(args[1], level=logging.ERROR, fg='red')
 
+			flush_command_logs()
 			self.sync_log_to_install_medium()
 
 			# We avoid printing /mnt/<log path> because that might confuse people if they note it down
@@ -155,6 +160,14 @@ class Installer:
 
 		self.genfstab()
 
+		binary_lookups = binary_cache_statistics()
+		self.log(f"Binary lookups served from cache: {binary_lookups['hits']} (searched $PATH {binary_lookups['misses']} times)", level=logging.DEBUG)
+		probes = probe_cache_statistics()
+		self.log(f"Disk probes served from cache: {probes['hits']} (executed {probes['misses']} times, invalidated {probes['invalidations']} times)", level=logging.DEBUG)
+		self.log(f"Partition table rescans requested: {rescan_statistics()}", level=logging.DEBUG)
+		self.log(f"Most time consuming commands during the installation:\n{command_statistics.report(top=10)}", level=logging.DEBUG)
+		self.log(f"Most frequently called commands during the installation:\n{command_statistics.report(top=10, sort_by='calls')}", level=logging.DEBUG)
+
 		if not (missing_steps := self.post_install_check()):
 			self.log('Installation completed without any errors. You may now reboot.', fg='green', level=logging.INFO)
 			self.sync_log_to_install_medium()
@@ -189,12 +202,13 @@ class Installer:
 
 		return True
 
-	def _create_keyfile(self,luks_handle , partition :dict, password :str):
+	def _create_keyfile(self,luks_handle , partition :dict, password :str) -> Optional[str]:
 		""" roiutine to create keyfiles, so it can be moved elsewere
+		returns the path of the key-file within the installation, for the crypttab entry
 		"""
 		if partition.get('generate-encryption-key-file'):
-			if not (cryptkey_dir := pathlib.Path(f"{self.target}/etc/cryptsetup-keys.d")).exists():
-				cryptkey_dir.mkdir(parents=True)
+			# key-files are created side by side, so another one may have created the directory already
+			pathlib.Path(f"{self.target}/etc/cryptsetup-keys.d").mkdir(parents=True, exist_ok=True)
 			# Once we store the key as ../xyzloop.key systemd-cryptsetup can automatically load this key
 			# if we name the device to "xyzloop".
 			if partition.get('mountpoint',None):
@@ -207,7 +221,9 @@ class Installer:
 			os.chmod(f"{self.target}{encryption_key_path}", 0o400)
 
 			luks_handle.add_key(pathlib.Path(f"{self.target}{encryption_key_path}"), password=password)
-			luks_handle.crypttab(self, encryption_key_path, options=["luks", "key-slot=1"])
+			return encryption_key_path
+
+		return None
 
 	def _has_root(self, partition :dict) -> bool:
 		"""
@@ -235,6 +251,7 @@ class Installer:
 			list_part.extend(layouts[blockdevice]['partitions'])
 
 		# we manage the encrypted partititons
+		unlocking = {}
 		for partition in [entry for entry in list_part if entry.get('encrypted',False)]:
 			# open the luks device and all associate stuff
 			if not (password := partition.get('!password', None)):
@@ -244,11 +261,14 @@ class Installer:
 			else:
 				loopdev = f"{storage.get('ENC_IDENTIFIER', 'ai')}{pathlib.Path(partition['device_instance'].path).name}"
 			# note that we DON'T auto_unmount (i.e. close the encrypted device so it can be used
-			with (luks_handle := luks2(partition['device_instance'], loopdev, password, auto_unmount=False)) as unlocked_device:
-				if partition.get('generate-encryption-key-file',False) and not self._has_root(partition):
-					list_luks_handles.append([luks_handle,partition,password])
-				# this way all the requesrs will be to the dm_crypt device and not to the physical partition
-				partition['device_instance'] = unlocked_device
+			luks_handle = luks2(partition['device_instance'], loopdev, password, auto_unmount=False)
+			if partition.get('generate-encryption-key-file',False) and not self._has_root(partition):
+				list_luks_handles.append([luks_handle,partition,password])
+			# unlocking takes a key derivation each, so the partitions are unlocked side by side
+			unlocking[partition['device_instance'].path] = functools.partial(self._unlock, luks_handle, partition)
+
+		if unlocking:
+			run_per_device(unlocking, 'unlock')
 
 		# we manage the btrfs partitions
 		for partition in [entry for entry in list_part if entry.get('btrfs', {}).get('subvolumes', {})]:
@@ -279,13 +299,28 @@ class Installer:
 			try:
 				get_mount_info(f"{self.target}{mountpoint}", traverse=False)
 			except DiskError:
-				raise DiskError(f"Target {self.target}{mountpoint} never got mounted properly (unable to get mount information using findmnt).")
+				raise DiskError(f"Target {self.target}{mountpoint} never got mounted properly (unable to find it in the mount table).")
 
 		# once everything is mounted, we generate the key files in the correct place
+		key_files = {}
+
+		def create_keyfile(handle :List[Any]) -> None:
+			log(f"creating key-file for {handle[1]['device_instance'].path}",level=logging.INFO)
+			key_files[id(handle)] = self._create_keyfile(handle[0],handle[1],handle[2])
+
+		if list_luks_handles:
+			# adding a key slot takes two key derivations, so those run side by side as well
+			run_per_device({handle[1]['device_instance'].path: functools.partial(create_keyfile, handle) for handle in list_luks_handles}, 'create a key-file for')
+
+		# the crypttab entries are written in order, once all key slots are added
 		for handle in list_luks_handles:
-			ppath = handle[1]['device_instance'].path
-			log(f"creating key-file for {ppath}",level=logging.INFO)
-			self._create_keyfile(handle[0],handle[1],handle[2])
+			if encryption_key_path := key_files.get(id(handle)):
+				handle[0].crypttab(self, encryption_key_path, options=["luks", "key-slot=1"])
+
+	def _unlock(self, luks_handle, partition :dict) -> None:
+		with luks_handle as unlocked_device:
+			# this way all the requesrs will be to the dm_crypt device and not to the physical partition
+			partition['device_instance'] = unlocked_device
 
 	def mount(self, partition :Partition, mountpoint :str, create_mountpoint :bool = True) -> None:
 		if create_mountpoint and not os.path.isdir(f'{self.target}{mountpoint}'):
@@ -811,7 +846,7 @@ class Installer:
 		root_fs_type = get_mount_fs_type(root_partition.filesystem)
 
 		if real_device := self.detect_encryption(root_partition):
-			root_uuid = SysCommand(f"blkid -s UUID -o value {real_device.path}").decode().rstrip()
+			root_uuid = SysCommand(f"blkid -s UUID -o value {real_device.path}", mode='pipe').decode().rstrip()
 			_file = "/etc/default/grub"
 			add_to_CMDLINE_LINUX = f"sed -i 's/GRUB_CMDLINE_LINUX=\"\"/GRUB_CMDLINE_LINUX=\"cryptdevice=UUID={root_uuid}:cryptlvm rootfstype={root_fs_type}\"/'"
 			enable_CRYPTODISK = "sed -i 's/#GRUB_ENABLE_CRYPTODISK=y/GRUB_ENABLE_CRYPTODISK=y/'"
@@ -2,13 +2,13 @@ import logging
 from typing import Iterator, List, Callable
 
 from .exceptions import ServiceException
-from .general import SysCommand
+from .general import SysCommand, SysCommandWorker
 from .output import log
 from .storage import storage
 
 def list_keyboard_languages() -> Iterator[str]:
-	for line in SysCommand("localectl --no-pager list-keymaps", environment_vars={'SYSTEMD_COLORS': '0'}):
-		yield line.decode('UTF-8').strip()
+	for line in SysCommandWorker("localectl --no-pager list-keymaps", environment_vars={'SYSTEMD_COLORS': '0'}).stream():
+		yield line.strip()
 
 
 def list_locales() -> List[str]:
@@ -125,8 +125,8 @@ def list_installed_locales() -> List[str]:
 	return lista
 
 def list_x11_keyboard_languages() -> Iterator[str]:
-	for line in SysCommand("localectl --no-pager list-x11-keymap-layouts", environment_vars={'SYSTEMD_COLORS': '0'}):
-		yield line.decode('UTF-8').strip()
+	for line in SysCommandWorker("localectl --no-pager list-x11-keymap-layouts", environment_vars={'SYSTEMD_COLORS': '0'}).stream():
+		yield line.strip()
 
 
 def verify_keyboard_layout(layout :str) -> bool:
@@ -164,5 +164,5 @@ def set_keyboard_language(locale :str) -> bool:
 
 
 def list_timezones() -> Iterator[str]:
-	for line in SysCommand("timedatectl --no-pager list-timezones", environment_vars={'SYSTEMD_COLORS': '0'}):
-		yield line.decode('UTF-8').strip()
+	for line in SysCommandWorker("timedatectl --no-pager list-timezones", environment_vars={'SYSTEMD_COLORS': '0'}).stream():
+		yield line.strip()
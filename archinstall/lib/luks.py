@@ -1,21 +1,75 @@
 from __future__ import annotations
+import contextlib
 import json
 import logging
 import os
 import pathlib
 import shlex
+import threading
 import time
-from typing import Optional, List,TYPE_CHECKING
+from typing import Iterator, Optional, List,TYPE_CHECKING
 # https://stackoverflow.com/a/39757388/929999
 if TYPE_CHECKING:
 	from .installer import Installer
 
 from .disk import Partition, convert_device_to_uuid
-from .general import SysCommand, SysCommandWorker
+from .general import SysCommand
 from .output import log
 from .exceptions import SysCallError, DiskError
 from .storage import storage
 
+# The memory the key derivations running right now have reserved, see pbkdf_memory()
+_pbkdf_condition = threading.Condition()
+_pbkdf_reserved = 0
+_pbkdf_budget = 0
+
+
+def available_memory() -> int:
+	"""
+	Returns ``MemAvailable`` from ``/proc/meminfo`` in KiB, or 0 if it can't be read.
+	"""
+	try:
+		with open('/proc/meminfo') as fh:
+			for line in fh:
+				if line.startswith('MemAvailable:'):
+					return int(line.split()[1])
+	except (OSError, ValueError, IndexError):
+		pass
+
+	return 0
+
+
+@contextlib.contextmanager
+def pbkdf_memory(cost :Optional[int] = None) -> Iterator[None]:
+	"""
+	Reserves the memory (in KiB, defaults to ``storage['LUKS_PBKDF_MEMORY']``) an argon2 key derivation needs
+	for as long as the block runs. Waits for other LUKS operations to finish first if running them side by side
+	would need more memory than was available, so formatting or unlocking several partitions at once can't run us out of RAM.
+	One derivation is always let through, however little memory there is.
+	"""
+	global _pbkdf_reserved, _pbkdf_budget
+
+	if cost is None:
+		cost = storage['LUKS_PBKDF_MEMORY']
+
+	with _pbkdf_condition:
+		while _pbkdf_reserved and _pbkdf_reserved + cost > _pbkdf_budget:
+			_pbkdf_condition.wait()
+
+		if not _pbkdf_reserved:
+			# Measured while no derivation runs, what the running ones use would otherwise be counted twice
+			_pbkdf_budget = available_memory()
+
+		_pbkdf_reserved += cost
+
+	try:
+		yield
+	finally:
+		with _pbkdf_condition:
+			_pbkdf_reserved -= cost
+			_pbkdf_condition.notify_all()
+
+
 class luks2:
 	def __init__(self,
 		partition :Partition,
@@ -82,7 +136,7 @@ class luks2:
 		with open(key_file, 'wb') as fh:
 			fh.write(password)
 
-		partition.partprobe()
+		partition.partprobe('luks2.encrypt()')
 
 		cryptsetup_args = shlex.join([
 			'/usr/bin/cryptsetup',
@@ -90,6 +144,7 @@ class luks2:
 			'--verbose',
 			'--type', 'luks2',
 			'--pbkdf', 'argon2id',
+			'--pbkdf-memory', str(storage['LUKS_PBKDF_MEMORY']),
 			'--hash', hash_type,
 			'--key-size', str(key_size),
 			'--iter-time', str(iter_time),
@@ -103,7 +158,10 @@ class luks2:
 			# which generates a "Device /dev/sdX does not exist or access denied." between
 			# setting up partitions and us trying to encrypt it.
 			for i in range(storage['DISK_RETRY_ATTEMPTS']):
-				if (cmd_handle := SysCommand(cryptsetup_args)).exit_code != 0:
+				with pbkdf_memory():
+					cmd_handle = SysCommand(cryptsetup_args)
+
+				if cmd_handle.exit_code != 0:
 					time.sleep(storage['DISK_TIMEOUTS'])
 				else:
 					break
@@ -119,7 +177,7 @@ class luks2:
 				# Get crypt-information about the device by doing a reverse lookup starting with the partition path
 				# For instance: /dev/sda
 				SysCommand(f'bash -c "partprobe"')
-				devinfo = json.loads(b''.join(SysCommand(f"lsblk --fs -J {partition.path}")).decode('UTF-8'))['blockdevices'][0]
+				devinfo = json.loads(b''.join(SysCommand(f"lsblk --fs -J {partition.path}", mode='pipe')).decode('UTF-8'))['blockdevices'][0]
 
 				# For each child (sub-partition/sub-device)
 				if len(children := devinfo.get('children', [])):
@@ -134,7 +192,8 @@ class luks2:
 						SysCommand(f"cryptsetup close {child['name']}")
 
 				# Then try again to set up the crypt-device
-				cmd_handle = SysCommand(cryptsetup_args)
+				with pbkdf_memory():
+					cmd_handle = SysCommand(cryptsetup_args)
 			else:
 				raise err
 
@@ -157,7 +216,8 @@ class luks2:
 		while pathlib.Path(partition.path).exists() is False and time.time() - wait_timer < 10:
 			time.sleep(0.025)
 
-		SysCommand(f'/usr/bin/cryptsetup open {partition.path} {mountpoint} --key-file {os.path.abspath(key_file)} --type luks2')
+		with pbkdf_memory():
+			SysCommand(f'/usr/bin/cryptsetup open {partition.path} {mountpoint} --key-file {os.path.abspath(key_file)} --type luks2')
 		if os.path.islink(f'/dev/mapper/{mountpoint}'):
 			self.mapdev = f'/dev/mapper/{mountpoint}'
 			unlocked_partition = Partition(self.mapdev, None, encrypted=True, filesystem=get_filesystem_type(self.mapdev), autodetect_filesystem=False)
@@ -179,16 +239,25 @@ class luks2:
 			raise OSError(2, f"Could not import {path} as a disk encryption key, file is missing.", str(path))
 
 		log(f'Adding additional key-file {path} for {self.partition}', level=logging.INFO)
-		worker = SysCommandWorker(f"/usr/bin/cryptsetup -q -v luksAddKey {self.partition.path} {path}",
-							environment_vars={'LC_ALL':'C'})
-		pw_injected = False
-		while worker.is_alive():
-			if b'Enter any existing passphrase' in worker and pw_injected is False:
-				worker.write(bytes(password, 'UTF-8'))
-				pw_injected = True
-
-		if worker.exit_code != 0:
-			raise DiskError(f'Could not add encryption key {path} to {self.partition} because: {worker}')
+
+		if not isinstance(password, bytes):
+			password = bytes(password, 'UTF-8')
+
+		# The existing passphrase is given as a key-file on stdin (--key-file -), the same way luksFormat got it
+		cryptsetup_args = [
+			'/usr/bin/cryptsetup', '--batch-mode', '--verbose',
+			'--pbkdf', 'argon2id',
+			'--pbkdf-memory', str(storage['LUKS_PBKDF_MEMORY']),
+			'--key-file', '-',
+			'luksAddKey', self.partition.path, str(path)
+		]
+
+		try:
+			# Unlocking the existing key slot and deriving the new one take a derivation each, one after the other
+			with pbkdf_memory():
+				SysCommand(cryptsetup_args, mode='pipe', stdin=password, environment_vars={'LC_ALL':'C'})
+		except SysCallError as error:
+			raise DiskError(f'Could not add encryption key {path} to {self.partition} because: {error}')
 
 		return True
 
@@ -1,8 +1,11 @@
+import atexit
+import contextlib
 import logging
 import os
 import sys
+import threading
 from pathlib import Path
-from typing import Dict, Union
+from typing import Dict, Iterator, Optional, TextIO, Union
 
 from .storage import storage
 
@@ -25,12 +28,81 @@ class Journald:
 		log_adapter.log(level, message)
 
 
+class BufferedLogFile:
+	"""
+	A long lived, buffered, append-only log file under ``storage['LOG_PATH']``.
+	It's meant for high volume logs such as the command history and command output,
+	where opening and closing the file for every write would cost a handful of syscalls per line.
+
+	The file is opened on the first write, re-opened if ``storage['LOG_PATH']`` changes
+	and flushed when :py:meth:`flush` is called or the interpreter exits.
+	"""
+	def __init__(self, filename :str, buffer_size :int = 64 * 1024) -> None:
+		self.filename = filename
+		self.buffer_size = buffer_size
+		self._path :Optional[str] = None
+		self._handle :Optional[TextIO] = None
+		self._lock = threading.Lock()
+		atexit.register(self.close)
+
+	def write(self, data :str) -> None:
+		with self._lock:
+			if (path := os.path.join(storage.get('LOG_PATH', './'), self.filename)) != self._path:
+				self._close()
+				self._path = path
+
+				try:
+					Path(path).parent.mkdir(exist_ok=True, parents=True)
+					self._handle = open(path, 'a', buffering=self.buffer_size)
+				except PermissionError:
+					self._handle = None
+
+			if self._handle:
+				self._handle.write(data)
+
+	def flush(self) -> None:
+		with self._lock:
+			if self._handle:
+				self._handle.flush()
+
+	def close(self) -> None:
+		with self._lock:
+			self._close()
+			self._path = None
+
+	def _close(self) -> None:
+		if self._handle:
+			self._handle.close()
+			self._handle = None
+
+
 # TODO: Replace log() for session based logging.
 class SessionLogging:
 	def __init__(self):
 		pass
 
 
+# The prefix of the current thread's log lines, see log_context()
+_log_context = threading.local()
+
+
+@contextlib.contextmanager
+def log_context(prefix :str) -> Iterator[None]:
+	"""
+	Prefixes everything the current thread logs with ``[prefix]``, so that the logs of work
+	done concurrently (on several disks for instance) can be told apart::
+
+		with log_context('/dev/sda'):
+			log('Formatting')  # [/dev/sda] Formatting
+	"""
+	previous = getattr(_log_context, 'prefix', None)
+	_log_context.prefix = prefix
+	try:
+		yield
+	finally:
+		_log_context.prefix = previous
+
+
 # Found first reference here: https://stackoverflow.com/questions/7445658/how-to-detect-if-the-console-does-support-ansi-escape-codes-in-python
 # And re-used this: https://github.com/django/django/blob/master/django/core/management/color.py#L12
 def supports_color() -> bool:
@@ -94,6 +166,9 @@ def stylize_output(text: str, *opts :str, **kwargs) -> str:
 def log(*args :str, **kwargs :Union[str, int, Dict[str, Union[str, int]]]) -> None:
 	string = orig_string = ' '.join([str(x) for x in args])
 
+	if prefix := getattr(_log_context, 'prefix', None):
+		string = orig_string = f"[{prefix}] {orig_string}"
+
 	# Attempt to colorize the output if supported
 	# Insert default colors and override with **kwargs
 	if supports_color():
@@ -0,0 +1,283 @@
+import contextlib
+import os
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from .replay import active_recorder, active_replay
+from .storage import storage
+
+# Read-only commands whose output is served from the cache as long as nothing touched the devices they look at.
+# sfdisk is only read-only when asked to dump the partition table, see is_probe().
+PROBE_BINARIES = ('blkid', 'findmnt', 'lsblk')
+# Commands that change partition tables, file systems, mappings or mounts of the devices given to them.
+# Any other command that names a device is assumed to change it as well, see is_mutating().
+MUTATING_BINARIES = (
+	'blkdiscard', 'btrfs', 'cryptsetup', 'dd', 'dmsetup', 'e2label', 'fatlabel', 'kpartx', 'losetup', 'lvcreate', 'mdadm',
+	'mkswap', 'mount', 'parted', 'partprobe', 'pvcreate', 'sgdisk', 'swapoff', 'swapon', 'tune2fs', 'umount', 'vgcreate', 'wipefs'
+)
+# Commands that can do just about anything, so we can't tell which devices they affected.
+OPAQUE_BINARIES = ('arch-chroot', 'bash', 'sh', 'systemd-nspawn', 'udevadm')
+# Stands for the probes that don't name a device (and look at all of them) in ProbeCache.tracking()
+ALL_DEVICES = '*'
+
+
+@dataclass
+class ProbeResult:
+	output: bytes
+	stderr: bytes
+
+
+def is_probe(cmd :List[str]) -> bool:
+	name = os.path.basename(cmd[0])
+	return name in PROBE_BINARIES or (name == 'sfdisk' and ('--json' in cmd or '-J' in cmd))
+
+
+def _device_arguments(cmd :List[str]) -> List[str]:
+	# /dev/sda as well as of=/dev/sda (dd)
+	return [arg.split('=', 1)[1] if arg.startswith(('if=', 'of=')) else arg for arg in cmd[1:] if arg.startswith(('/dev/', 'if=/dev/', 'of=/dev/'))]
+
+
+def is_mutating(cmd :List[str]) -> bool:
+	name = os.path.basename(cmd[0])
+	if name == 'sfdisk':
+		return not is_probe(cmd)
+
+	if name in MUTATING_BINARIES or name in OPAQUE_BINARIES or name.startswith('mkfs'):
+		return True
+
+	# Whatever we don't know, but which is given a device, might as well have changed it
+	return not is_probe(cmd) and bool(_device_arguments(cmd))
+
+
+def _parent_devices(path :str) -> Optional[Set[str]]:
+	"""
+	Returns the name(s) of the whole disk(s) behind ``path``, so that /dev/sda1 as well
+	as a /dev/mapper/ device living on it both resolve to ``sda``.
+	Returns None if the device can't be found in /sys/class/block.
+	"""
+	name = os.path.basename(os.path.realpath(path))
+	sys_path = f'/sys/class/block/{name}'
+
+	if not os.path.exists(sys_path):
+		return None
+
+	if os.path.exists(f'{sys_path}/partition'):
+		return {os.path.basename(os.path.dirname(os.path.realpath(sys_path)))}
+
+	try:
+		slaves = os.listdir(f'{sys_path}/slaves')
+	except OSError:
+		slaves = []
+
+	if not slaves:
+		return {name}
+
+	devices :Set[str] = set()
+	for slave in slaves:
+		if (parents := _parent_devices(f'/dev/{slave}')) is None:
+			return None
+		devices |= parents
+
+	return devices
+
+
+class ProbeCache:
+	"""
+	Memoizes the output of read-only probes (``lsblk``, ``blkid``, ``findmnt`` and ``sfdisk --json``)
+	executed through :ref:`SysCommandWorker`.
+
+	Every disk has a generation counter which mutating commands bump for the disks they were given.
+	A cached probe is only served as long as the generations of the disks it looked at are unchanged,
+	probes that don't name any device (``lsblk -J`` for instance) are invalidated by any mutation.
+	Mutations where the affected disks can't be told apart (``umount -R /mnt``, ``bash -c ...``) throw
+	away the whole cache.
+	"""
+	def __init__(self) -> None:
+		self._entries :Dict[Tuple[Any, ...], Tuple[Tuple[Any, ...], ProbeResult]] = {}
+		self._generations :Dict[str, int] = {}
+		self._global_generation = 0
+		self._epoch = 0
+		self._statistics = {'hits': 0, 'misses': 0, 'invalidations': 0}
+		self._lock = threading.Lock()
+		self._tracked = threading.local()
+
+	@property
+	def enabled(self) -> bool:
+		if active_recorder() or active_replay():
+			# Every probe has to end up in (and come from) the recording, on whatever host it's replayed
+			return False
+
+		return storage.get('PROBE_CACHE', True)
+
+	@property
+	def generation(self) -> Tuple[int, int]:
+		"""
+		Changes every time a mutating command runs, for anything derived from probes to tell when it's stale.
+		"""
+		self._track({ALL_DEVICES})
+
+		with self._lock:
+			return (self._epoch, self._global_generation)
+
+	def device_generation(self, path :str) -> Optional[Tuple[Any, ...]]:
+		"""
+		Changes every time a mutating command touches the disk ``path`` lives on.
+		Returns None if the device can't be found, meaning there's no telling when it changes.
+		"""
+		if (devices := _parent_devices(path)) is None:
+			return None
+
+		self._track(devices)
+
+		with self._lock:
+			return (self._epoch, *((device, self._generations.get(device, 0)) for device in sorted(devices)))
+
+	@contextlib.contextmanager
+	def tracking(self) -> Iterator[Set[str]]:
+		"""
+		Collects the disks that the probes run in this thread (and the snapshots derived from them) look at,
+		with :py:data:`ALL_DEVICES` standing for those that look at every disk. See :py:meth:`expire`.
+		"""
+		if not hasattr(self._tracked, 'stack'):
+			self._tracked.stack = []
+
+		devices :Set[str] = set()
+		self._tracked.stack.append(devices)
+		try:
+			yield devices
+		finally:
+			self._tracked.stack.pop()
+
+	def _track(self, devices :Set[str]) -> None:
+		for tracked in getattr(self._tracked, 'stack', []):
+			tracked |= devices
+
+	def expire(self, devices :Set[str]) -> None:
+		"""
+		Makes the probes of ``devices`` (as collected by :py:meth:`tracking`) run again, leaving the rest of the cache alone.
+		Unlike :py:meth:`invalidate` nothing was changed, so it doesn't count as an invalidation.
+		"""
+		with self._lock:
+			for device in devices:
+				if device == ALL_DEVICES:
+					self._global_generation += 1
+				else:
+					self._generations[device] = self._generations.get(device, 0) + 1
+
+	def _key(self, cmd :List[str], environment_vars :Dict[str, Any]) -> Tuple[Any, ...]:
+		return (tuple(cmd), tuple(sorted(environment_vars.items())))
+
+	def _devices(self, cmd :List[str]) -> Optional[Set[str]]:
+		devices :Set[str] = set()
+		for arg in _device_arguments(cmd):
+			if (parents := _parent_devices(arg)) is None:
+				return None
+			devices |= parents
+
+		return devices
+
+	def stamp(self, cmd :List[str]) -> Optional[Tuple[Any, ...]]:
+		"""
+		Returns the generations a probe's result depends on,
+		or None if the probe can't be cached (a device it names doesn't exist for instance).
+		"""
+		if not self.enabled or not is_probe(cmd):
+			return None
+
+		if (devices := self._devices(cmd)) is None:
+			return None
+
+		self._track(devices or {ALL_DEVICES})
+
+		with self._lock:
+			if not devices:
+				return (self._epoch, self._global_generation)
+
+			return (self._epoch, *((device, self._generations.get(device, 0)) for device in sorted(devices)))
+
+	def fetch(self, cmd :List[str], environment_vars :Dict[str, Any]) -> Optional[ProbeResult]:
+		if (stamp := self.stamp(cmd)) is None:
+			return None
+
+		with self._lock:
+			if (entry := self._entries.get(self._key(cmd, environment_vars))) and entry[0] == stamp:
+				self._statistics['hits'] += 1
+				return entry[1]
+
+			self._statistics['misses'] += 1
+			return None
+
+	def store(self, cmd :List[str], environment_vars :Dict[str, Any], stamp :Tuple[Any, ...], result :ProbeResult) -> None:
+		with self._lock:
+			# Only keep it if nothing was mutated while the probe ran
+			if stamp[0] == self._epoch:
+				self._entries[self._key(cmd, environment_vars)] = (stamp, result)
+
+	def invalidate(self, cmd :Optional[List[str]] = None) -> None:
+		"""
+		Bumps the generation of the disks ``cmd`` operates on,
+		or of all of them if that can't be determined (or no ``cmd`` was given).
+		"""
+		devices = None
+		if cmd and os.path.basename(cmd[0]) not in OPAQUE_BINARIES:
+			devices = self._devices(cmd)
+
+		with self._lock:
+			self._statistics['invalidations'] += 1
+			self._global_generation += 1
+
+			if not devices:
+				self._epoch += 1
+				self._entries.clear()
+				return
+
+			for device in devices:
+				self._generations[device] = self._generations.get(device, 0) + 1
+
+	def command_started(self, cmd :List[str]) -> Optional[Tuple[Any, ...]]:
+		"""
+		Called right before ``cmd`` is executed. Returns the stamp to store the result under if it's a cacheable probe.
+		"""
+		if is_mutating(cmd):
+			self.invalidate(cmd)
+			return None
+
+		return self.stamp(cmd)
+
+	def command_finished(self, cmd :List[str], environment_vars :Dict[str, Any], stamp :Optional[Tuple[Any, ...]], exit_code :Optional[int], output :Any, stderr :Any) -> None:
+		"""
+		Called once ``cmd`` has exited. ``output`` and ``stderr`` can be any bytes-like objects, they're only copied if the result is cached.
+		"""
+		if is_mutating(cmd):
+			# Once more, in case a probe ran and got cached while the mutation was in progress
+			self.invalidate(cmd)
+		elif stamp is not None and exit_code == 0:
+			self.store(cmd, environment_vars, stamp, ProbeResult(output=bytes(output), stderr=bytes(stderr)))
+
+	def statistics(self) -> Dict[str, int]:
+		with self._lock:
+			return {**self._statistics, 'cached': len(self._entries)}
+
+	def clear(self) -> None:
+		with self._lock:
+			self._epoch += 1
+			self._entries.clear()
+
+
+probe_cache = ProbeCache()
+
+
+def flush_probe_cache() -> None:
+	"""
+	Throws away all cached probe results, for instance after changing disks outside of :ref:`SysCommand`.
+	"""
+	probe_cache.clear()
+
+
+def probe_cache_statistics() -> Dict[str, int]:
+	"""
+	Returns how many probes were served from the cache (``hits``), how many had to be executed (``misses``)
+	and how many times mutating commands invalidated parts of it (``invalidations``).
+	"""
+	return probe_cache.statistics()
@@ -0,0 +1,300 @@
+import base64
+import glob
+import json
+import os
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, TextIO, Tuple, Union
+
+from .exceptions import ReplayError
+from .output import log
+
+
+@dataclass
+class RecordedCommand:
+	"""
+	One command as executed by :ref:`SysCommandWorker`, stored as one JSON object per line in a fixture file.
+	``output`` and ``stderr`` are kept as raw bytes (base64 encoded in the file), pty line endings and all.
+	"""
+	cmd: List[str]
+	environment: Dict[str, Any]
+	exit_code: Optional[int]
+	output: bytes
+	stderr: bytes
+	wall_time: float
+
+	@property
+	def key(self) -> Tuple[Any, ...]:
+		return command_key(self.cmd, self.environment)
+
+	def json(self) -> Dict[str, Any]:
+		return {
+			'cmd': self.cmd,
+			'environment': self.environment,
+			'exit_code': self.exit_code,
+			'output': base64.b64encode(self.output).decode('ASCII'),
+			'stderr': base64.b64encode(self.stderr).decode('ASCII'),
+			'wall_time': self.wall_time
+		}
+
+	@classmethod
+	def parse(cls, data :Dict[str, Any]) -> 'RecordedCommand':
+		return cls(
+			cmd=data['cmd'],
+			environment=data.get('environment', {}),
+			exit_code=data['exit_code'],
+			output=base64.b64decode(data.get('output', '')),
+			stderr=base64.b64decode(data.get('stderr', '')),
+			wall_time=data.get('wall_time', 0.0)
+		)
+
+
+@dataclass
+class RecordedRead:
+	"""
+	One read of the system that doesn't go through a command, such as reading a file in ``/sys`` (``kind`` ``read``)
+	or globbing for block devices (``kind`` ``glob``), see :py:func:`recorded`.
+	Stored in the same fixture files as :ref:`RecordedCommand`, told apart by having a ``kind``.
+	"""
+	kind: str
+	argument: str
+	value: Any
+	errno: Optional[int] = None
+
+	@property
+	def key(self) -> Tuple[str, str]:
+		return (self.kind, self.argument)
+
+	def json(self) -> Dict[str, Any]:
+		return {
+			'kind': self.kind,
+			'argument': self.argument,
+			'value': self.value,
+			'errno': self.errno
+		}
+
+	@classmethod
+	def parse(cls, data :Dict[str, Any]) -> 'RecordedRead':
+		return cls(
+			kind=data['kind'],
+			argument=data['argument'],
+			value=data.get('value'),
+			errno=data.get('errno')
+		)
+
+
+def command_key(cmd :List[str], environment :Dict[str, Any]) -> Tuple[Any, ...]:
+	# Binaries live in different places on different machines, so only the name of it is significant.
+	return (os.path.basename(cmd[0]), *cmd[1:], tuple(sorted(environment.items())))
+
+
+class CommandRecorder:
+	"""
+	Appends every command executed through :ref:`SysCommandWorker` (its argv, environment,
+	output and exit code) to the fixture file ``path``, for :ref:`CommandReplay` to serve later::
+
+		with CommandRecorder('/tmp/8-disks.jsonl'):
+			archinstall.all_blockdevices()
+	"""
+	def __init__(self, path :str) -> None:
+		self.path = path
+		self._fh :Optional[TextIO] = None
+		self._lock = threading.Lock()
+
+	def __enter__(self) -> 'CommandRecorder':
+		self.start()
+		return self
+
+	def __exit__(self, *args :Any) -> None:
+		self.stop()
+
+	def start(self) -> None:
+		global _active_recorder
+
+		self._fh = open(self.path, 'a')
+		_active_recorder = self
+		log(f"Recording executed commands to {self.path}")
+
+	def stop(self) -> None:
+		global _active_recorder
+
+		if _active_recorder is self:
+			_active_recorder = None
+
+		with self._lock:
+			if self._fh:
+				self._fh.close()
+				self._fh = None
+
+	def record(self, entry :Union[RecordedCommand, RecordedRead]) -> None:
+		with self._lock:
+			if self._fh:
+				self._fh.write(json.dumps(entry.json()) + '\n')
+				self._fh.flush()
+
+
+class CommandReplay:
+	"""
+	Serves commands from a fixture file recorded by :ref:`CommandRecorder` instead of executing them.
+
+	Commands are matched on their argv and environment, and a command that was recorded several times
+	returns its recordings in the order they were made (the last one repeats once they run out).
+	A command that's missing from the fixture raises :ref:`ReplayError` rather than touching the machine.
+	The same goes for the reads of ``/sys``, ``/run/udev`` and ``/proc`` that were recorded (see :py:func:`recorded`).
+
+	:param latency: ``None`` returns results instantly, a number of seconds delays every command by that much
+		and ``'recorded'`` delays every command by the wall time it took when it was recorded.
+	:type latency: float, str, optional
+
+	:param latency_scale: Multiplier for the delay, for instance ``0.5`` to simulate twice as fast disks.
+	:type latency_scale: float
+	"""
+	def __init__(self, path :str, latency :Union[None, float, str] = None, latency_scale :float = 1.0) -> None:
+		if latency is not None and latency != 'recorded' and not isinstance(latency, (int, float)):
+			raise ValueError(f"CommandReplay() latency has to be None, a number of seconds or 'recorded', not {latency}")
+
+		self.path = path
+		self.latency = latency
+		self.latency_scale = latency_scale
+		self._recordings :Dict[Tuple[Any, ...], List[RecordedCommand]] = {}
+		self._reads :Dict[Tuple[str, str], List[RecordedRead]] = {}
+		self._positions :Dict[Tuple[Any, ...], int] = {}
+		self._lock = threading.Lock()
+
+		with open(path, 'r') as fh:
+			for line_number, line in enumerate(fh, start=1):
+				if not line.strip():
+					continue
+
+				try:
+					data = json.loads(line)
+					if 'kind' in data:
+						read = RecordedRead.parse(data)
+						self._reads.setdefault(read.key, []).append(read)
+					else:
+						command = RecordedCommand.parse(data)
+						self._recordings.setdefault(command.key, []).append(command)
+				except (ValueError, KeyError) as error:
+					raise ReplayError(f"Invalid recording on line {line_number} of {path}: {error}")
+
+	def __enter__(self) -> 'CommandReplay':
+		self.start()
+		return self
+
+	def __exit__(self, *args :Any) -> None:
+		self.stop()
+
+	def start(self) -> None:
+		global _active_replay
+
+		# Rewind, so that the same instance replays identically every time
+		with self._lock:
+			self._positions = {}
+
+		_active_replay = self
+		log(f"Replaying commands from {self.path}")
+
+	def stop(self) -> None:
+		global _active_replay
+
+		if _active_replay is self:
+			_active_replay = None
+
+	def fetch(self, cmd :List[str], environment :Dict[str, Any]) -> Tuple[RecordedCommand, float]:
+		"""
+		Returns the next recording of ``cmd`` and how long it should appear to run for.
+		"""
+		key = command_key(cmd, environment)
+
+		with self._lock:
+			if not (recordings := self._recordings.get(key)):
+				raise ReplayError(f"{cmd} was never recorded in {self.path}")
+
+			position = self._positions.get(key, 0)
+			self._positions[key] = position + 1
+
+		command = recordings[min(position, len(recordings) - 1)]
+
+		if self.latency is None:
+			latency = 0.0
+		elif self.latency == 'recorded':
+			latency = command.wall_time
+		else:
+			latency = float(self.latency)
+
+		return command, latency * self.latency_scale
+
+	def fetch_read(self, kind :str, argument :str) -> RecordedRead:
+		"""
+		Returns the next recording of a read of the system, in the same order as :py:meth:`fetch` does for commands.
+		"""
+		key = (kind, argument)
+
+		with self._lock:
+			if not (reads := self._reads.get(key)):
+				raise ReplayError(f"{kind} of {argument} was never recorded in {self.path}")
+
+			position = self._positions.get(key, 0)
+			self._positions[key] = position + 1
+
+		return reads[min(position, len(reads) - 1)]
+
+
+_active_recorder :Optional[CommandRecorder] = None
+_active_replay :Optional[CommandReplay] = None
+
+
+def active_recorder() -> Optional[CommandRecorder]:
+	return _active_recorder
+
+
+def active_replay() -> Optional[CommandReplay]:
+	return _active_replay
+
+
+def recorded(kind :str, argument :str, function :Callable[[], Any]) -> Any:
+	"""
+	Returns ``function()``, a read of ``argument`` from the system that doesn't go through :ref:`SysCommand`.
+	While a :ref:`CommandRecorder` is active the result is recorded under ``kind``, and while a :ref:`CommandReplay`
+	is active the recorded result is returned without calling ``function()``.
+
+	``function()`` has to return something JSON serializable. An OSError it raises is recorded (and replayed) as well.
+	"""
+	if replay := active_replay():
+		read = replay.fetch_read(kind, argument)
+		if read.errno is not None:
+			raise OSError(read.errno, os.strerror(read.errno), argument)
+
+		return read.value
+
+	try:
+		value = function()
+	except OSError as error:
+		if recorder := active_recorder():
+			recorder.record(RecordedRead(kind, argument, None, error.errno))
+		raise
+
+	if recorder := active_recorder():
+		recorder.record(RecordedRead(kind, argument, value))
+
+	return value
+
+
+def read_file(path :str) -> str:
+	def read() -> str:
+		with open(path) as fh:
+			return fh.read()
+
+	return recorded('read', path, read)
+
+
+def glob_paths(pattern :str) -> List[str]:
+	return recorded('glob', pattern, lambda: sorted(glob.glob(pattern)))
+
+
+def path_exists(path :str) -> bool:
+	return recorded('exists', path, lambda: os.path.exists(path))
+
+
+def real_path(path :str) -> str:
+	return recorded('realpath', path, lambda: os.path.realpath(path))
@@ -24,6 +24,10 @@ storage: Dict[str, Any] = {
 	'ENC_IDENTIFIER': 'ainst',
 	'DISK_TIMEOUTS' : 1, # seconds
 	'DISK_RETRY_ATTEMPTS' : 20, # RETRY_ATTEMPTS * DISK_TIMEOUTS is used in disk operations
+	'DISK_WORKERS' : 4, # How many disks are partitioned, encrypted and formatted at the same time
+	'LUKS_PBKDF_MEMORY' : 1048576, # KiB argon2id may use per key slot (cryptsetup's default maximum), concurrent LUKS operations are limited by it
 	'CMD_LOCALE':{'LC_ALL':'C'}, # default locale for execution commands. Can be overriden with set_cmd_locale()
 	'CMD_LOCALE_DEFAULT':{'LC_ALL':'C'}, # should be the same as the former. Not be used except in reset_cmd_locale()
+	'CMD_OUTPUT_MEMORY_LIMIT': 4096, # KiB of command output kept in memory, the rest is spilled to a file under LOG_PATH
+	'PROBE_CACHE': True, # Serve repeated lsblk/blkid/findmnt/sfdisk --json calls from a cache until a mutating command touches the device
 }
@@ -78,10 +78,13 @@ def perform_disk_operations():
 		if archinstall.has_uefi() is False:
 			mode = archinstall.MBR
 
-		for drive in archinstall.arguments.get('harddrives', []):
-			if archinstall.arguments.get('disk_layouts', {}).get(drive.path):
-				with archinstall.Filesystem(drive, mode) as fs:
-					fs.load_layout(archinstall.arguments['disk_layouts'][drive.path])
+		# Every drive is set up on its own, so they're set up side by side
+		layouts = {
+			drive: archinstall.arguments['disk_layouts'][drive.path]
+			for drive in archinstall.arguments.get('harddrives', [])
+			if archinstall.arguments.get('disk_layouts', {}).get(drive.path)
+		}
+		archinstall.load_layouts(layouts, mode)
 
 def perform_installation(mountpoint):
 	"""
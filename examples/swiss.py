@@ -353,10 +353,13 @@ def perform_filesystem_operations():
 		if archinstall.has_uefi() is False:
 			mode = archinstall.MBR
 
-		for drive in archinstall.arguments.get('harddrives', []):
-			if archinstall.arguments.get('disk_layouts', {}).get(drive.path):
-				with archinstall.Filesystem(drive, mode) as fs:
-					fs.load_layout(archinstall.arguments['disk_layouts'][drive.path])
+		# Every drive is set up on its own, so they're set up side by side
+		layouts = {
+			drive: archinstall.arguments['disk_layouts'][drive.path]
+			for drive in archinstall.arguments.get('harddrives', [])
+			if archinstall.arguments.get('disk_layouts', {}).get(drive.path)
+		}
+		archinstall.load_layouts(layouts, mode)
 
 def disk_setup(installation):
 	# Mount all the drives to the desired mountpoint
@@ -0,0 +1,109 @@
+import json
+import re
+import tempfile
+import time
+
+import archinstall
+
+# Measures how fast recorded pacstrap output makes it through SysCommandWorker, the VT100 escape code stripping
+# of every line in particular, by replaying it (see archinstall.CommandReplay) instead of installing anything.
+#
+# A recording can be made during any installation, for instance:
+#
+#   with archinstall.CommandRecorder('/tmp/pacstrap.jsonl'):
+#       installation.minimal_installation()
+#
+#   python -m archinstall --script vt100_benchmark --fixture=/tmp/pacstrap.jsonl
+#
+# Without --fixture a synthetic recording of pacman style progress bars is used.
+# --command picks which of the recorded commands to replay (pacstrap by default) and --rounds how often.
+
+if archinstall.arguments.get('help', None):
+	archinstall.log(" - Recording to replay via --fixture=<path.jsonl>")
+	archinstall.log(" - Recorded binary to replay via --command=<name>, defaults to pacstrap")
+	archinstall.log(" - Number of rounds to take the best of via --rounds=<n>, defaults to 3")
+
+
+def legacy_clear_vt100_escape_codes(data :bytes) -> bytes:
+	# How clear_vt100_escape_codes() used to do it, to compare with
+	for match in re.findall(rb'\x1B\[[?0-9;]*[a-zA-Z]', data, re.IGNORECASE):
+		data = data.replace(match, b'')
+
+	return data
+
+
+def synthetic_fixture(path :str) -> None:
+	# pacman redraws its progress bar with a carriage return for every step, so each package ends up as one long line
+	lines = []
+	for package in range(1, 201):
+		lines.append(b''.join(
+			b'\r\x1b[K(%3d/200) installing package-%d   [%s%s] %3d%%\x1b[0m' % (package, package, b'#' * step, b'-' * (50 - step), step * 2)
+			for step in range(51)
+		))
+
+	recording = archinstall.RecordedCommand(
+		cmd=['/usr/bin/pacstrap', '-C', '/etc/pacman.conf', '/mnt', 'base', '--noconfirm'],
+		environment=archinstall.storage['CMD_LOCALE'],
+		exit_code=0,
+		output=b'\r\n'.join(lines) + b'\r\n',
+		stderr=b'',
+		wall_time=0.0
+	)
+
+	with open(path, 'w') as fh:
+		fh.write(json.dumps(recording.json()) + '\n')
+
+
+def recorded_commands(path :str, name :str) -> list:
+	recordings = []
+	with open(path) as fh:
+		for line in fh:
+			# Lines with a "kind" are recorded file reads, not commands
+			if line.strip() and 'kind' not in (data := json.loads(line)):
+				if (recording := archinstall.RecordedCommand.parse(data)).cmd[0].split('/')[-1] == name:
+					recordings.append(recording)
+
+	return recordings
+
+
+def best_of(rounds :int, function) -> float:
+	timings = []
+	for _ in range(rounds):
+		started = time.perf_counter()
+		function()
+		timings.append(time.perf_counter() - started)
+
+	return min(timings)
+
+
+def replay_lines(recording :archinstall.RecordedCommand) -> None:
+	with archinstall.SysCommandWorker(recording.cmd, environment_vars=recording.environment, remove_vt100_escape_codes_from_lines=True) as worker:
+		worker.make_sure_we_are_executing()
+		for _ in worker:
+			pass
+
+
+def throughput(size :int, seconds :float) -> str:
+	return f"{size / max(seconds, 1e-9) / 1024 ** 2:8.1f} MiB/s"
+
+
+if not (fixture := archinstall.arguments.get('fixture', None)):
+	fixture = tempfile.NamedTemporaryFile(prefix='archinstall-pacstrap-', suffix='.jsonl', delete=False).name
+	synthetic_fixture(fixture)
+
+command = archinstall.arguments.get('command', None) or 'pacstrap'
+rounds = int(archinstall.arguments.get('rounds', None) or 3)
+
+if not (recordings := recorded_commands(fixture, command)):
+	archinstall.log(f"{fixture} has no recording of {command}", fg="red")
+	exit(1)
+
+with archinstall.CommandReplay(fixture):
+	for recording in recordings:
+		lines = recording.output.split(b'\n')
+		size = len(recording.output)
+
+		print(f"{' '.join(recording.cmd)}: {size} bytes in {len(lines)} lines")
+		print(f"  SysCommandWorker lines:             {throughput(size, best_of(rounds, lambda: replay_lines(recording)))}")
+		print(f"  clear_vt100_escape_codes():          {throughput(size, best_of(rounds, lambda: [archinstall.clear_vt100_escape_codes(line) for line in lines]))}")
+		print(f"  previous clear_vt100_escape_codes(): {throughput(size, best_of(rounds, lambda: [legacy_clear_vt100_escape_codes(line) for line in lines]))}")